@@ -0,0 +1,187 @@
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from crawl_backend import VehicleNotFound, parse_price
+from db_declarative import Database
+from fipe_api import CARRO, FipeApi
+from metrics import NOT_FOUND, REGISTRY, RETRIES, price_saved
+from sinks import PriceSink, database_sink, price_record
+
+FAN_OUT = {'marca': 4, 'modelo': 8, 'ano': 16}
+
+FAILED = REGISTRY.counter('fipe_crawl_failures_total', 'Nós da árvore deixados pendentes depois de um erro')
+
+
+class TokenBucket:
+    """
+    Limita a taxa global de requisições em `rate` por segundo,
+    permitindo rajadas de até `capacity` requisições.
+    """
+
+    def __init__(self, rate: float, capacity: float = None, loop=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.tokens = self.capacity
+        self.last = self.loop.time()
+
+    def _refill(self):
+        now = self.loop.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncCrawler:
+    """
+    Percorre a árvore referência -> marca -> modelo -> ano de forma concorrente
+    usando a API JSON. As chamadas HTTP rodam em um pool de threads, limitadas por
+    `concurrency` requisições simultâneas e `rate` requisições por segundo;
+    `fan_out` limita quantos nós de cada nível são expandidos ao mesmo tempo.
+    O banco de dados e o `sink` dos preços são acessados apenas pela thread do event loop.
+
+    Um erro em um nó é registrado e não interrompe os irmãos: o nó e os seus
+    ancestrais continuam não visitados, para a próxima execução.
+    """
+
+    def __init__(self, api: FipeApi = None, database: Database = None, concurrency: int = 8,
+                 rate: float = 10, fan_out: dict = None, vehicle_type: int = CARRO, retries: int = 3,
+                 sink: PriceSink = None):
+        self.api = api if api is not None else FipeApi()
+        self.database = database if database is not None else Database(vehicle_type=vehicle_type)
+        self.sink = sink if sink is not None else database_sink(self.database)
+        self.concurrency = concurrency
+        self.rate = rate
+        self.fan_out = dict(FAN_OUT, **(fan_out or {}))
+        self.vehicle_type = vehicle_type
+        self.retries = retries
+        self.loop = None
+        self.executor = None
+        self.in_flight = None
+        self.bucket = None
+        self.levels = None
+
+    async def call(self, func, *args):
+        for attempt in range(self.retries + 1):
+            async with self.in_flight:
+                await self.bucket.acquire()
+                try:
+                    return await self.loop.run_in_executor(self.executor, func, *args)
+                except VehicleNotFound:
+                    raise
+                except Exception as err:
+                    if attempt == self.retries:
+                        raise
+                    sys.stderr.write('{}\n'.format(err))
+                    RETRIES.inc()
+            await asyncio.sleep(2 ** attempt)
+
+    async def isolated(self, name: str, coroutine) -> bool:
+        # retorna False se o nó ou algum descendente falhou
+        try:
+            result = await coroutine
+        except Exception as err:
+            sys.stderr.write('{}: {}\n'.format(name, err))
+            FAILED.inc()
+            return False
+        return result is not False
+
+    async def crawl_ano(self, reference, codes: tuple, marca, modelo, ano, ano_code: str):
+        async with self.levels['ano']:
+            try:
+                result = await self.call(self.api.price, *codes, ano_code, self.vehicle_type)
+            except VehicleNotFound as err:
+                sys.stderr.write('{}\n'.format(err))
+                NOT_FOUND.inc()
+                self.database.delete_ano(ano.id)
+                return
+            self.sink.write([
+                price_record(reference, marca, modelo, ano, result['CodigoFipe'], parse_price(result['Valor']))
+            ])
+            price_saved()
+
+    async def crawl_modelo(self, reference, codes: tuple, marca, modelo, modelo_code):
+        async with self.levels['modelo']:
+            codes = codes + (modelo_code,)
+            options = await self.call(self.api.anos, *codes, self.vehicle_type)
+            anos = {option['Label']: option['Value'] for option in options}
+            if not self.database.get_unvisited_anos(modelo.id):
+                self.database.save_anos(list(anos), modelo.id)
+            tasks = [
+                self.isolated(ano.ano_modelo, self.crawl_ano(
+                    reference, codes, marca, modelo, ano, anos[ano.ano_modelo]
+                ))
+                for ano in self.database.get_unvisited_anos(modelo.id) if ano.ano_modelo in anos
+            ]
+        # os filhos rodam fora do semáforo para não bloquear a expansão de outros modelos
+        if not all(await asyncio.gather(*tasks)):
+            return False
+        self.database.set_modelo_visited(modelo.id)
+
+    async def crawl_marca(self, reference, ref_code, marca, marca_code):
+        async with self.levels['marca']:
+            options = await self.call(self.api.modelos, ref_code, marca_code, self.vehicle_type)
+            modelos = {str(option['Label']): option['Value'] for option in options}
+            if not self.database.get_unvisited_modelos(marca.id):
+                print(datetime.now(), reference.text, marca.marca_name)
+                self.database.save_modelos(list(modelos), marca.id)
+            tasks = [
+                self.isolated(modelo.modelo_name, self.crawl_modelo(
+                    reference, (ref_code, marca_code), marca, modelo, modelos[modelo.modelo_name]
+                ))
+                for modelo in self.database.get_unvisited_modelos(marca.id) if modelo.modelo_name in modelos
+            ]
+        if not all(await asyncio.gather(*tasks)):
+            return False
+        self.database.set_marca_visited(marca.id)
+
+    async def crawl_reference(self, reference, ref_code):
+        options = await self.call(self.api.marcas, ref_code, self.vehicle_type)
+        marcas = {option['Label']: option['Value'] for option in options}
+        if not self.database.get_unvisited_marcas(reference.id):
+            self.database.save_marcas(list(marcas), reference.id)
+        done = await asyncio.gather(*(
+            self.isolated(marca.marca_name, self.crawl_marca(reference, ref_code, marca, marcas[marca.marca_name]))
+            for marca in self.database.get_unvisited_marcas(reference.id) if marca.marca_name in marcas
+        ))
+        if not all(done):
+            return False
+        self.database.set_reference_visited(reference.id)
+
+    async def crawl(self):
+        options = await self.call(self.api.references)
+        references = {option['Mes'].strip(): option['Codigo'] for option in options}
+        self.database.save_reference(list(references))
+        # uma referência com nós pendentes encerra o percurso e fica para a próxima execução,
+        # pois as seguintes tomariam esses nós como uma execução interrompida
+        for reference in self.database.get_unvisited_references():
+            if reference.text not in references:
+                sys.stderr.write('referência {} não está mais disponível\n'.format(reference.text))
+                self.database.set_reference_visited(reference.id)
+                continue
+            if not await self.isolated(reference.text, self.crawl_reference(reference, references[reference.text])):
+                sys.stderr.write('referência {} incompleta\n'.format(reference.text))
+                break
+
+    def run(self, close_sink: bool = True):
+        # close_sink=False mantém aberto um sink que ainda será usado por outro crawler
+        self.loop = asyncio.get_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.in_flight = asyncio.Semaphore(self.concurrency)
+        self.bucket = TokenBucket(self.rate, loop=self.loop)
+        self.levels = {level: asyncio.Semaphore(limit) for level, limit in self.fan_out.items()}
+        try:
+            self.loop.run_until_complete(self.crawl())
+        finally:
+            self.executor.shutdown()
+            if close_sink:
+                self.sink.close()
@@ -0,0 +1,197 @@
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import threading
+from contextlib import redirect_stdout
+from time import monotonic
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_scraper():
+    # fipe-scraper.py não pode ser importado pelo nome por causa do hífen
+    spec = importlib.util.spec_from_file_location('fipe_scraper', os.path.join(HERE, 'fipe-scraper.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def process_tree_rss(pid: int) -> int:
+    # memória residente, em kB, do processo e de todos os seus descendentes (Linux)
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open('/proc/{}/status'.format(current)) as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+            for task in os.listdir('/proc/{}/task'.format(current)):
+                with open('/proc/{}/task/{}/children'.format(current, task)) as children:
+                    pending.extend(int(child) for child in children.read().split())
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+class RssSampler(threading.Thread):
+    """
+    Mede periodicamente a memória do processo e de seus descendentes
+    (ex.: geckodriver e Firefox) e guarda o maior valor observado.
+    """
+
+    def __init__(self, pid: int = None, interval: float = 0.5):
+        super().__init__(name='rss-sampler', daemon=True)
+        self.pid = pid if pid is not None else os.getpid()
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while True:
+            self.peak = max(self.peak, process_tree_rss(self.pid))
+            if self.stopped.wait(self.interval):
+                return
+
+    def stop(self) -> int:
+        self.stopped.set()
+        self.join()
+        return self.peak
+
+
+def bench_crawl(backend: str = 'http', storage: str = 'direct', catalog: tuple = (1, 5, 10, 5),
+                latency: float = 0, error_rate: float = 0, database_url: str = None, options=()) -> dict:
+    """
+    Executa o scraper do início ao fim contra o site simulado, no modo escolhido
+    pelas `options` da linha de comando do fipe-scraper.py, e mede a
+    vazão, as idas ao banco por preço, os reinícios do backend e o pico de memória.
+    """
+    from sqlalchemy import event
+
+    import metrics
+    from db_declarative import Base, Database, Price, create_indexes, get_engine
+    from mock_fipe import MockFipeServer, SyntheticCatalog
+
+    scraper = load_scraper()
+    server = MockFipeServer(SyntheticCatalog(*catalog), latency=latency, error_rate=error_rate, seed=0).start()
+    path = None
+    if database_url is None:
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        database_url = 'sqlite:///' + path
+
+    engine = get_engine(database_url)
+    Base.metadata.create_all(engine)
+    create_indexes(engine)
+    round_trips = [0]
+
+    def count(*args):
+        round_trips[0] += 1
+    event.listen(engine, 'before_cursor_execute', count)
+
+    args = scraper.parse_args([
+        '--backend', backend,
+        '--api-url', server.url,
+        '--site-url', server.site_url,
+        '--database-url', database_url,
+    ] + (['--write-behind'] if storage == 'write-behind' else []) + list(options))
+    restarts = metrics.RESTARTS.value
+    sampler = RssSampler()
+    sampler.start()
+    try:
+        begin = monotonic()
+        with redirect_stdout(sys.stderr):
+            scraper.crawl(args)
+        elapsed = monotonic() - begin
+        prices = Database(database_url).session.query(Price).count()
+    finally:
+        peak = sampler.stop()
+        event.remove(engine, 'before_cursor_execute', count)
+        server.stop()
+        if path is not None:
+            os.unlink(path)
+    return {
+        'backend': backend,
+        'storage': storage,
+        'catalog': dict(zip(('references', 'marcas', 'modelos', 'anos'), catalog)),
+        'latency': latency,
+        'error_rate': error_rate,
+        'prices': prices,
+        'seconds': round(elapsed, 3),
+        'prices_per_second': round(prices / elapsed, 2),
+        'db_round_trips': round_trips[0],
+        'db_round_trips_per_price': round(round_trips[0] / prices, 2) if prices else None,
+        'restarts': metrics.RESTARTS.value - restarts,
+        'peak_rss_kb': peak,
+    }
+
+
+def bench_profile(lean: bool, pages: int, template_dir: str = None) -> dict:
+    from firefox_profile import lean_profile
+    scraper = load_scraper()
+
+    begin = monotonic()
+    browser = scraper.Browser(profile=lean_profile(template_dir=template_dir) if lean else None)
+    startup = monotonic() - begin
+    try:
+        begin = monotonic()
+        for _ in range(pages):
+            scraper.Browser.open(browser.browser)
+        elapsed = monotonic() - begin
+        rss = process_tree_rss(browser.browser.service.process.pid)
+    finally:
+        browser.close()
+    return {
+        'lean': lean,
+        'pages': pages,
+        'startup_seconds': round(startup, 3),
+        'pages_per_minute': round(pages / elapsed * 60, 2),
+        'rss_kb': rss,
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmarks do scraper da tabela FIPE')
+    commands = parser.add_subparsers(dest='command')
+
+    profile = commands.add_parser('profile', help='páginas por minuto com e sem o perfil enxuto do Firefox')
+    profile.add_argument('--pages', type=int, default=20)
+    profile.add_argument('--profile-dir', help='perfil salvo por firefox_profile.save_template')
+
+    crawl = commands.add_parser('crawl', help='crawl completo contra o site simulado de mock_fipe; '
+                                'as demais opções são repassadas ao fipe-scraper.py')
+    crawl.add_argument('--backend', choices=('browser', 'http'), nargs='+', default=['http'])
+    crawl.add_argument('--storage', choices=('direct', 'write-behind'), nargs='+', default=['direct'])
+    crawl.add_argument('--catalog', type=int, nargs=4, default=[1, 5, 10, 5],
+                       metavar=('REFERENCIAS', 'MARCAS', 'MODELOS', 'ANOS'))
+    crawl.add_argument('--latency', type=float, default=0, help='segundos de espera em cada requisição da API')
+    crawl.add_argument('--error-rate', type=float, default=0, help='fração das requisições que falham')
+    crawl.add_argument('--database-url', help='banco vazio usado nas medições (padrão: SQLite temporário)')
+
+    # as opções desconhecidas do crawl são repassadas ao fipe-scraper.py
+    args, options = parser.parse_known_args(args)
+    if options and args.command != 'crawl':
+        parser.error('argumentos não reconhecidos: {}'.format(' '.join(options)))
+    if args.command == 'profile':
+        results = [bench_profile(lean, args.pages, args.profile_dir) for lean in (False, True)]
+    elif args.command == 'crawl':
+        results = [
+            bench_crawl(backend, storage, tuple(args.catalog), args.latency, args.error_rate,
+                        args.database_url, options)
+            for backend in args.backend
+            for storage in args.storage
+        ]
+    else:
+        parser.print_help()
+        return 1
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+import queue
+import sys
+import threading
+
+from crawl_backend import CrawlBackend
+from metrics import REGISTRY
+
+RECYCLES = REGISTRY.counter('fipe_browser_recycles_total', 'Sessões do navegador trocadas por uma reserva')
+
+
+class BrowserPool(CrawlBackend):
+    """
+    Backend que repassa as chamadas para uma sessão ativa do navegador e mantém
+    `spares` sessões reserva já abertas na aba de consulta. Em uma falha, ou
+    depois de `max_queries` consultas, a sessão ativa é trocada por uma reserva
+    e encerrada em segundo plano, limitando o crescimento de memória do Firefox.
+    `generation` é incrementado a cada troca, quando os campos do formulário são perdidos.
+
+    `factory` deve criar uma nova sessão pronta para consulta (ex.: Browser).
+    """
+
+    def __init__(self, factory, spares: int = 1, max_queries: int = 1000, max_backoff: float = 60,
+                 spare_timeout: float = 120):
+        self.factory = factory
+        self.max_queries = max_queries
+        self.max_backoff = max_backoff
+        self.spare_timeout = spare_timeout
+        self.spares = queue.Queue(maxsize=spares)
+        self.stopped = threading.Event()
+        self.active = self.create()
+        self.queries = 0
+        self.restarts = 0
+        self.generation = 0
+        self.filler = threading.Thread(target=self.fill, name='browser-pool', daemon=True)
+        self.filler.start()
+        REGISTRY.gauge('fipe_browser_spares', 'Sessões reserva prontas').set_function(self.spares.qsize)
+
+    def create(self):
+        # cria uma sessão, tentando novamente com espera exponencial limitada
+        delay = 1
+        while True:
+            try:
+                return self.factory()
+            except Exception as err:
+                sys.stderr.write('{}\n'.format(err))
+                if self.stopped.wait(delay):
+                    return None
+                delay = min(self.max_backoff, delay * 2)
+
+    def fill(self):
+        while not self.stopped.is_set():
+            browser = self.create()
+            if browser is None:
+                return
+            while not self.stopped.is_set():
+                try:
+                    self.spares.put(browser, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+            else:
+                browser.close()
+
+    def retire(self, browser):
+        def close():
+            try:
+                browser.close()
+            except Exception as err:
+                sys.stderr.write('{}\n'.format(err))
+        threading.Thread(target=close, daemon=True).start()
+
+    def swap(self, timeout: float = None):
+        while True:
+            try:
+                spare = self.spares.get(timeout=self.spare_timeout if timeout is None else timeout)
+            except queue.Empty:
+                raise RuntimeError('nenhuma sessão reserva disponível')
+            alive = getattr(spare, 'alive', None)
+            if alive is None or alive():
+                break
+            self.retire(spare)
+        old, self.active = self.active, spare
+        self.queries = 0
+        self.generation += 1
+        RECYCLES.inc()
+        self.retire(old)
+
+    def references(self) -> list:
+        return self.active.references()
+
+    def marcas(self) -> list:
+        return self.active.marcas()
+
+    def modelos(self) -> list:
+        return self.active.modelos()
+
+    def anos(self) -> list:
+        return self.active.anos()
+
+    def select_reference(self, reference: str):
+        self.active.select_reference(reference)
+
+    def select_marca(self, marca: str, arrow_down: bool = False):
+        self.active.select_marca(marca, arrow_down)
+
+    def select_modelo(self, modelo: str):
+        self.active.select_modelo(modelo)
+
+    def select_ano(self, ano: str):
+        self.active.select_ano(ano)
+
+    def search(self) -> dict:
+        result = self.active.search()
+        self.queries += 1
+        if self.queries >= self.max_queries:
+            # recicla a sessão entre duas consultas; a Application
+            # seleciona novamente os campos antes da próxima
+            try:
+                self.swap(timeout=0.01)
+            except RuntimeError:
+                # sem reserva pronta, continua com a sessão atual
+                pass
+        return result
+
+    def restart(self):
+        self.restarts += 1
+        self.swap()
+
+    def close(self):
+        self.stopped.set()
+        self.filler.join()
+        while True:
+            try:
+                self.spares.get_nowait().close()
+            except queue.Empty:
+                break
+        self.active.close()
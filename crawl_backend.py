@@ -0,0 +1,54 @@
+class VehicleNotFound(Exception):
+    pass
+
+
+def parse_price(text: str) -> float:
+    return float(text.replace('R$ ', '').replace('.', '').replace(',', '.'))
+
+
+class CrawlBackend:
+    """
+    Interface usada pela Application para percorrer a árvore
+    referência -> marca -> modelo -> ano e consultar o preço.
+    Os valores trocados são sempre os textos exibidos no site,
+    que são os mesmos salvos no banco de dados.
+    """
+
+    def references(self) -> list:
+        raise NotImplementedError
+
+    def marcas(self) -> list:
+        raise NotImplementedError
+
+    def modelos(self) -> list:
+        raise NotImplementedError
+
+    def anos(self) -> list:
+        raise NotImplementedError
+
+    def select_reference(self, reference: str):
+        raise NotImplementedError
+
+    def select_marca(self, marca: str, arrow_down: bool = False):
+        raise NotImplementedError
+
+    def select_modelo(self, modelo: str):
+        raise NotImplementedError
+
+    def select_ano(self, ano: str):
+        raise NotImplementedError
+
+    def search(self) -> dict:
+        """
+        Consulta o veículo selecionado e retorna um dicionário com
+        as chaves 'fipe_code' e 'price' (texto, ex.: 'R$ 10.000,00')
+        e, quando disponíveis, 'reference' e 'authentication'.
+        Lança VehicleNotFound quando o site não possui o veículo.
+        """
+        raise NotImplementedError
+
+    def restart(self):
+        pass
+
+    def close(self):
+        pass
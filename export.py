@@ -0,0 +1,223 @@
+"""
+Exportação e análise dos preços gravados pelo scraper.
+
+Os preços são lidos da junção price, ano_modelo, modelo, marca e referencia
+com um cursor no servidor, em blocos de `chunk_size` linhas, então o uso de
+memória não depende de quantas referências há no banco.
+
+uso:
+    python export.py parquet DIRETÓRIO   um arquivo parquet por mês de referência
+    python export.py changes             variação mensal de cada ano modelo, em CSV
+    python export.py depreciation        fração do preço mantida por ano modelo e idade
+
+O parquet requer o pyarrow e as análises, o numpy.
+"""
+import argparse
+import csv
+import os
+import sys
+
+from sqlalchemy import select
+
+from db_declarative import ENGINE, AnoModelo, Marca, Modelo, Price, Referencia, get_engine
+from fipe_api import ZERO_KM
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+CHUNK_ROWS = 50000
+
+PRICE_COLUMNS = (
+    Referencia.period, Referencia.text.label('reference'), Referencia.vehicle_type, Marca.marca_name.label('marca'),
+    Modelo.modelo_name.label('modelo'), Modelo.fipe_code, AnoModelo.year, AnoModelo.fuel, Price.value,
+)
+
+
+def _joined(columns) -> select:
+    return select(columns).select_from(
+        Price.__table__
+        .join(AnoModelo.__table__, AnoModelo.id == Price.id_ano_modelo)
+        .join(Modelo.__table__, Modelo.id == AnoModelo.modelo_id)
+        .join(Marca.__table__, Marca.id == Modelo.marca_id)
+        .join(Referencia.__table__, Referencia.id == Price.id_referencia)
+    )
+
+
+def stream(query, url: str = ENGINE, chunk_size: int = CHUNK_ROWS):
+    # listas de até `chunk_size` linhas; no Postgres o resultado fica no servidor
+    with get_engine(url).connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+
+def _require(module, package: str):
+    if module is None:
+        raise RuntimeError('esta função requer o pacote {}'.format(package))
+
+
+def month_key(period) -> str:
+    return '{:04d}-{:02d}'.format(period.year, period.month)
+
+
+def export_parquet(directory: str, url: str = ENGINE, chunk_size: int = CHUNK_ROWS) -> dict:
+    """
+    Grava os preços em DIRETÓRIO/month=AAAA-MM/prices.parquet, um row
+    group por bloco lido. Como a consulta vem ordenada pelo período, só um
+    arquivo fica aberto por vez. Devolve o número de preços por mês.
+    """
+    _require(pyarrow, 'pyarrow')
+    schema = pyarrow.schema([
+        ('period', pyarrow.date32()),
+        ('reference', pyarrow.string()),
+        ('vehicle_type', pyarrow.int8()),
+        ('marca', pyarrow.string()),
+        ('modelo', pyarrow.string()),
+        ('fipe_code', pyarrow.string()),
+        ('year', pyarrow.int16()),
+        ('fuel', pyarrow.int8()),
+        ('value', pyarrow.float64()),
+    ])
+    query = _joined(PRICE_COLUMNS).order_by(Referencia.period)
+    counts = {}
+    writer, current = None, None
+
+    def write(rows):
+        columns = [pyarrow.array([row[i] for row in rows], field.type) for i, field in enumerate(schema)]
+        writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+        counts[current] += len(rows)
+
+    try:
+        for rows in stream(query, url, chunk_size):
+            start = 0
+            for i, row in enumerate(rows):
+                key = month_key(row.period)
+                if key == current:
+                    continue
+                if i > start:
+                    write(rows[start:i])
+                start = i
+                if writer is not None:
+                    writer.close()
+                current = key
+                counts[key] = 0
+                partition = os.path.join(directory, 'month={}'.format(key))
+                os.makedirs(partition, exist_ok=True)
+                writer = pyarrow.parquet.ParquetWriter(os.path.join(partition, 'prices.parquet'), schema)
+            write(rows[start:])
+    finally:
+        if writer is not None:
+            writer.close()
+    return counts
+
+
+def price_history(url: str = ENGINE, chunk_size: int = CHUNK_ROWS):
+    """
+    Série de preços de cada ano modelo, ordenada por ano modelo e período, em
+    blocos de arrays numpy: ano_id, month (ano * 12 + mês - 1), year e value.
+    Os zero km ficam de fora, pois não têm idade.
+    """
+    _require(numpy, 'numpy')
+    query = _joined((AnoModelo.id, Referencia.period, AnoModelo.year, Price.value)) \
+        .where(AnoModelo.year != ZERO_KM).order_by(AnoModelo.id, Referencia.period)
+    for rows in stream(query, url, chunk_size):
+        yield {
+            'ano_id': numpy.fromiter((row[0] for row in rows), numpy.int64, len(rows)),
+            'month': numpy.fromiter((row[1].year * 12 + row[1].month - 1 for row in rows), numpy.int32, len(rows)),
+            'year': numpy.fromiter((row[2] for row in rows), numpy.int32, len(rows)),
+            'value': numpy.fromiter((row[3] or 0 for row in rows), numpy.float64, len(rows)),
+        }
+
+
+def month_over_month(url: str = ENGINE, chunk_size: int = CHUNK_ROWS):
+    """
+    Variação de cada preço em relação ao mês anterior do mesmo ano modelo, em
+    blocos com ano_id, month e change (0.01 = 1%). Meses sem o preço anterior
+    ou com preço zero não têm variação.
+    """
+    previous = None
+    for chunk in price_history(url, chunk_size):
+        if previous is not None:
+            # a série de um ano modelo pode continuar no bloco seguinte
+            chunk = {key: numpy.concatenate((previous[key], values)) for key, values in chunk.items()}
+        values = chunk['value']
+        valid = (chunk['ano_id'][1:] == chunk['ano_id'][:-1]) & (numpy.diff(chunk['month']) == 1) & (values[:-1] > 0)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            change = values[1:] / values[:-1] - 1
+        yield {'ano_id': chunk['ano_id'][1:][valid], 'month': chunk['month'][1:][valid], 'change': change[valid]}
+        previous = {key: values[-1:] for key, values in chunk.items()}
+
+
+def depreciation(url: str = ENGINE, chunk_size: int = CHUNK_ROWS) -> list:
+    """
+    Curva de depreciação por ano modelo: para cada ano e idade em anos, a média
+    da fração do primeiro preço registrado que o veículo ainda vale. Devolve
+    tuplas (year, age, retained, count) ordenadas.
+    """
+    totals, counts = {}, {}
+    carry_id, carry_base = None, None
+    for chunk in price_history(url, chunk_size):
+        ids, values = chunk['ano_id'], chunk['value']
+        positions = numpy.arange(len(ids))
+        start = numpy.ones(len(ids), dtype=bool)
+        start[1:] = ids[1:] != ids[:-1]
+        start[0] = ids[0] != carry_id
+        first = numpy.maximum.accumulate(numpy.where(start, positions, 0))
+        base = values[first]
+        if not start[0]:
+            # continuação da série do bloco anterior
+            base[first == 0] = carry_base
+        valid = base > 0
+        age = numpy.maximum(chunk['month'] // 12 - chunk['year'], 0)
+        keys, inverse = numpy.unique(chunk['year'][valid] * 1000 + age[valid], return_inverse=True)
+        sums = numpy.bincount(inverse, weights=values[valid] / base[valid], minlength=len(keys))
+        sizes = numpy.bincount(inverse, minlength=len(keys))
+        for key, total, size in zip(keys.tolist(), sums.tolist(), sizes.tolist()):
+            totals[key] = totals.get(key, 0.0) + total
+            counts[key] = counts.get(key, 0) + size
+        carry_id, carry_base = ids[-1], base[-1]
+    return [(key // 1000, key % 1000, totals[key] / counts[key], counts[key]) for key in sorted(totals)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exportação e análise dos preços da tabela FIPE')
+    parser.add_argument('--url', default=ENGINE, help='banco do scraper')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_ROWS, help='linhas lidas do banco por vez')
+    commands = parser.add_subparsers(dest='command')
+    parquet = commands.add_parser('parquet', help='exporta os preços em parquet particionado por mês')
+    parquet.add_argument('directory')
+    commands.add_parser('changes', help='variação mensal dos preços, em CSV')
+    commands.add_parser('depreciation', help='curvas de depreciação por ano modelo, em CSV')
+    args = parser.parse_args()
+
+    writer = csv.writer(sys.stdout)
+    if args.command == 'parquet':
+        for key, count in sorted(export_parquet(args.directory, args.url, args.chunk_size).items()):
+            print(key, count)
+    elif args.command == 'changes':
+        writer.writerow(('ano_id', 'reference', 'change'))
+        for chunk in month_over_month(args.url, args.chunk_size):
+            for ano_id, month, change in zip(chunk['ano_id'].tolist(), chunk['month'].tolist(),
+                                             chunk['change'].tolist()):
+                writer.writerow((ano_id, '{:04d}-{:02d}'.format(month // 12, month % 12 + 1), round(change, 6)))
+    elif args.command == 'depreciation':
+        writer.writerow(('year', 'age', 'retained', 'count'))
+        for year, age, retained, count in depreciation(args.url, args.chunk_size):
+            writer.writerow((year, age, round(retained, 6), count))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
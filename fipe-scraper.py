@@ -2,6 +2,7 @@
 
 
 import sys
+import argparse
 from time import sleep
 from datetime import datetime
 
@@ -10,85 +11,212 @@ from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.firefox.options import Options
 from selenium.common.exceptions import ElementClickInterceptedException, NoSuchElementException
 
-from db_declarative import Database, Price
+from async_crawler import FAN_OUT, AsyncCrawler
+from browser_pool import BrowserPool
+from crawl_backend import CrawlBackend, VehicleNotFound, parse_price
+from db_declarative import ENGINE, Database
+from fipe_api import API_URL, CARRO, CAMINHAO, MOTO, VEHICLE_NAMES, VEHICLE_TYPES, FipeApi, HttpBackend
+from firefox_profile import lean_profile
+from frontier import Frontier
+from lease import CrawlNode, LeaseManager
+import metrics
+from reprice import Repricer
+from response_cache import CacheMiss, CachingBackend, open_cache
+from sinks import MultiSink, PriceSink, database_sink, file_sink, price_record
+from vehicle_crawl import VehicleCrawl
+from waits import AdaptiveWait, LatencyTracker
+from worker_pool import WorkerPool
+from write_behind import WriteBehind
 
 start = datetime.now()
 
+SITE_URL = 'http://veiculos.fipe.org.br/'
+
+# aba do site com o formulário de cada tipo de veículo
+VEHICLE_TABS = {
+    CARRO: 'Consulta de Carros e Utilitários Pequenos',
+    MOTO: 'Consulta de Motos',
+    CAMINHAO: 'Consulta de Caminhões e Micro-Ônibus',
+}
+
+OPTION_LIST_SCRIPT = '''
+var options = document.getElementById(arguments[0]).options;
+var list = [];
+for (var i = 0; i < options.length; i++) {
+    var text = options[i].textContent.trim();
+    if (text !== '') list.push(text);
+}
+return list;
+'''
+
+RESULT_TABLE_SCRIPT = '''
+var table = document.querySelector('#' + arguments[0] + ' table');
+var rows = [];
+if (table === null) return rows;
+for (var i = 0; i < table.rows.length; i++) {
+    var cells = table.rows[i].cells;
+    if (cells.length >= 2) rows.push([cells[0].textContent.trim(), cells[1].textContent.trim()]);
+}
+return rows;
+'''
+
+SELECTED_OPTION_SCRIPT = '''
+var select = document.getElementById(arguments[0]);
+var option = select === null ? null : select.options[select.selectedIndex];
+return option ? option.textContent.trim() : null;
+'''
+
+CLEAR_RESULT_SCRIPT = '''
+var table = document.querySelector('#' + arguments[0] + ' table');
+if (table !== null) table.parentNode.removeChild(table);
+'''
+
+RESULT_LABELS = {
+    'mês de referência': 'reference',
+    'código fipe': 'fipe_code',
+    'marca': 'marca',
+    'modelo': 'modelo',
+    'ano modelo': 'ano',
+    'autenticação': 'authentication',
+    'data da consulta': 'date',
+    'preço médio': 'price',
+}
+
+
+def parse_result(rows: list) -> dict:
+    # as linhas da tabela de resultado são identificadas pelo rótulo, não pela posição
+    result = {}
+    for label, value in rows:
+        key = RESULT_LABELS.get(label.rstrip(':').strip().lower())
+        if key is not None:
+            result[key] = value
+    return result
+
+
+class FormState:
+    """
+    Guarda o que está selecionado em cada campo do formulário de consulta.
+    Alterar um campo apaga, no site, os campos que dependem dele.
+    """
+    FIELDS = ('reference', 'marca', 'modelo', 'ano')
 
-class Browser:
     def __init__(self):
+        self.values = dict.fromkeys(self.FIELDS)
+
+    def is_selected(self, field: str, value: str) -> bool:
+        return self.values[field] == value
+
+    def invalidate(self, field: str = 'reference'):
+        for name in self.FIELDS[self.FIELDS.index(field):]:
+            self.values[name] = None
+
+    def select(self, field: str, value: str):
+        self.invalidate(field)
+        self.values[field] = value
+
+
+class Browser(CrawlBackend):
+    """
+    Consulta o site da FIPE pelo Firefox, no formulário do tipo de veículo
+    `vehicle_type`. Os ids dos campos de cada formulário terminam com o nome
+    do tipo, ex.: selectMarcacarro, selectMarcamoto e selectMarcacaminhao.
+    """
+
+    def __init__(self, tracker: LatencyTracker = None, profile=None, url: str = SITE_URL, vehicle_type: int = CARRO):
+        self.form = FormState()
+        self.tracker = tracker if tracker is not None else LatencyTracker()
+        self.profile = profile
+        self.url = url
+        self.vehicle_type = vehicle_type
+        self.browser = self.start(profile, url, vehicle_type)
+        self.ready()
+
+    @staticmethod
+    def start(profile=None, url: str = SITE_URL, vehicle_type: int = CARRO):
         options = Options()
         options.add_argument('-headless')
-        self.browser = webdriver.Firefox(
+        browser = webdriver.Firefox(
+            firefox_profile=profile,
             executable_path=r'firefox/geckodriver',
             firefox_options=options
         )
         try:
-            self.browser.get('http://veiculos.fipe.org.br/')
-            self.browser.find_element_by_link_text('Consulta de Carros e Utilitários Pequenos').click()
-        except Exception as err:
-            sys.stderr.write(str(err))
-            self.browser.close()
-            self = Browser()
+            Browser.open(browser, url, vehicle_type)
+        except Exception:
+            browser.quit()
+            raise
+        return browser
+
+    @staticmethod
+    def open(browser, url: str = SITE_URL, vehicle_type: int = CARRO):
+        browser.get(url)
+        browser.find_element_by_link_text(VEHICLE_TABS[vehicle_type]).click()
+
+    def ready(self):
+        # a lista de referências é carregada por ajax depois da abertura da aba
+        try:
+            self.wait = AdaptiveWait(self.browser, self.tracker)
+            self.wait.install()
+            self.wait.options('open', self.element_id('selectTabelaReferencia'))
+        except Exception:
+            self.browser.quit()
+            raise
+
+    def element_id(self, name: str) -> str:
+        # 'selectMarca' -> 'selectMarcacarro'
+        return name + VEHICLE_NAMES[self.vehicle_type]
+
+    def chosen_input(self, name: str):
+        return self.browser.find_element_by_xpath('//*[@id="{}_chosen"]/div/div/input'.format(self.element_id(name)))
 
     @property
     def input_ref(self):
-        return self.browser.find_element_by_xpath('//*[@id="selectTabelaReferenciacarro_chosen"]/div/div/input')
+        return self.chosen_input('selectTabelaReferencia')
 
     @property
     def input_marca(self):
-        return self.browser.find_element_by_xpath('//*[@id="selectMarcacarro_chosen"]/div/div/input')
+        return self.chosen_input('selectMarca')
 
     @property
     def input_modelo(self):
-        return self.browser.find_element_by_xpath('//*[@id="selectAnoModelocarro_chosen"]/div/div/input')
+        return self.chosen_input('selectAnoModelo')
 
     @property
     def input_ano(self):
-        return self.browser.find_element_by_xpath('//*[@id="selectAnocarro_chosen"]/div/div/input')
-
-    @property
-    def option_ref(self):
-        return self.browser.find_element_by_xpath('//*[@id="selectTabelaReferenciacarro"]/option')
+        return self.chosen_input('selectAno')
 
     @property
-    def option_marca(self):
-        return self.browser.find_element_by_xpath('//*[@id="selectMarcacarro"]/option')
+    def search_button(self):
+        return self.browser.find_element_by_id(self.element_id('buttonPesquisar'))
 
     @property
-    def option_modelo(self):
-        list = self.browser.find_element_by_xpath('//*[@id="selectAnoModelocarro"]/option')
-        return list if list else self.option_modelo
-
-    @property
-    def option_ano(self):
-        return self.browser.find_element_by_xpath('//*[@id="selectAnocarro"]/option')
-
-    @property
-    def search(self):
-        return self.browser.find_element_by_id('buttonPesquisarcarro')
+    def clear(self):
+        return self.browser.find_element_by_id(self.element_id('buttonLimparPesquisar'))
 
     @property
-    def clear(self):
-        return self.browser.find_element_by_id('buttonLimparPesquisarcarro')
+    def result_id(self) -> str:
+        return 'resultadoConsulta{}Filtros'.format(VEHICLE_NAMES[self.vehicle_type])
 
     @property
     def select_ano_result(self) -> str:
         try:
             return self.browser \
-                .find_element_by_xpath('//div[@id="selectAnocarro_chosen"]//ul[@class="chosen-results"]/li') \
+                .find_element_by_xpath(
+                    '//div[@id="{}_chosen"]//ul[@class="chosen-results"]/li'.format(self.element_id('selectAno'))
+                ) \
                 .get_attribute('innerHTML')
         except Exception as err:
-            sys.stderr.write(str(err))
+            sys.stderr.write('{}\n'.format(err))
             return ''
 
     @property
-    def search_result(self):
-        return self.browser.find_elements_by_xpath('//div[@id="resultadoConsultacarroFiltros"]/table//td')
+    def search_result(self) -> dict:
+        rows = self.browser.execute_script(RESULT_TABLE_SCRIPT, self.result_id)
+        return parse_result(rows or [])
 
-    @staticmethod
-    def get_option_list(opt: list):
-        return [o.get_attribute('innerHTML').replace('&amp;', '&') for o in opt if o.get_attribute('innerHTML') != '']
+    def get_option_list(self, select_id: str) -> list:
+        # todos os textos do select em uma única chamada ao navegador
+        return self.browser.execute_script(OPTION_LIST_SCRIPT, select_id)
 
     @staticmethod
     def input_send_keys(input_text, keys: str):
@@ -98,196 +226,512 @@ class Browser:
     def input_send_keys_with_arrow_down(input_text, keys: str):
         input_text.send_keys(keys, Keys.ARROW_DOWN, Keys.ENTER)
 
+    def references(self) -> list:
+        return self.get_option_list(self.element_id('selectTabelaReferencia'))
+
+    def marcas(self) -> list:
+        return self.get_option_list(self.element_id('selectMarca'))
+
+    def modelos(self) -> list:
+        return self.get_option_list(self.element_id('selectAnoModelo'))
+
+    def anos(self) -> list:
+        return self.get_option_list(self.element_id('selectAno'))
+
+    def change(self, field: str, value: str, action, select_name: str):
+        # só altera o campo quando o valor é diferente do selecionado
+        if self.form.is_selected(field, value):
+            return
+        self.form.invalidate(field)
+        action()
+        # quando o texto não corresponde a nenhuma opção, o chosen mantém
+        # a opção anterior, e a consulta traria o preço de outro veículo
+        selected = self.browser.execute_script(SELECTED_OPTION_SCRIPT, self.element_id(select_name))
+        if selected != value.strip():
+            raise VehicleNotFound('{} {} não encontrado, selecionado: {}'.format(field, value, selected))
+        self.form.select(field, value)
+
+    def select_reference(self, reference: str):
+        def action():
+            mark = self.wait.xhr_mark()
+            self.input_send_keys(self.input_ref, reference)
+            self.wait.xhr('reference', mark)  # aguarda o load do ajax
+        self.change('reference', reference, action, 'selectTabelaReferencia')
+
+    def select_marca(self, marca: str, arrow_down: bool = False):
+        def action():
+            mark = self.wait.xhr_mark()
+            if arrow_down:
+                self.input_send_keys_with_arrow_down(self.input_marca, marca)
+            else:
+                self.input_send_keys(self.input_marca, marca)
+            self.wait.xhr('marca', mark)  # aguarda o load do ajax
+        self.change('marca', marca, action, 'selectMarca')
+
+    def select_modelo(self, modelo: str):
+        def action():
+            mark = self.wait.xhr_mark()
+            self.input_send_keys(self.input_modelo, modelo)
+            self.wait.xhr('modelo', mark)  # aguarda o carregamento do ajax
+        self.change('modelo', modelo, action, 'selectAnoModelo')
+
+    def select_ano(self, ano: str):
+        def action():
+            mark = self.wait.xhr_mark()
+            self.input_send_keys(self.input_ano, ano)
+            self.wait.xhr('ano', mark)
+        self.change('ano', ano, action, 'selectAno')
+
+    def search(self) -> dict:
+        # o formulário não é limpo entre as consultas, então o resultado
+        # anterior é removido para não ser lido no lugar do novo
+        self.browser.execute_script(CLEAR_RESULT_SCRIPT, self.result_id)
+        try:
+            self.search_button.click()
+        except ElementClickInterceptedException as err:
+            self.form.invalidate('ano')
+            if self.select_ano_result.startswith('Nada encontrado com'):
+                raise VehicleNotFound(str(err))
+            raise
+        self.wait.result('search', self.result_id)
+        result = self.search_result
+        if 'fipe_code' not in result or 'price' not in result:
+            raise NoSuchElementException('resultado da consulta incompleto: {}'.format(result))
+        return result
+
+    def alive(self) -> bool:
+        try:
+            return self.browser.current_url is not None
+        except Exception:
+            return False
+
+    def restart(self):
+        self.form = FormState()
+        self.browser.quit()
+        self.browser = self.start(self.profile, self.url, self.vehicle_type)
+        self.ready()
+
     def close(self):
         self.browser.quit()
 
 
 class Application:
-    def __init__(self):
-        self.browser = Browser()
-        self.database = Database()
+    def __init__(self, backend: CrawlBackend = None, database: Database = None, writer: WriteBehind = None,
+                 incremental: bool = False, sink: PriceSink = None, vehicle_type: int = CARRO):
+        # o backend e o banco devem ser do mesmo tipo de veículo da Application
+        self.vehicle_type = vehicle_type
+        self.backend = backend if backend is not None else Browser(vehicle_type=vehicle_type)
+        self.database = database if database is not None else Database(vehicle_type=vehicle_type)
+        self.writer = writer
+        # sem o writer, os preços são gravados pelo sink na thread do scraper
+        self.sink = sink if sink is not None else database_sink(self.database)
+        self.incremental = incremental
         self.reference = None
         self.marca = None
         self.modelo = None
         self.ano = None
 
-    def restart_browser(self):
-        try:
-            self.browser.browser.quit()
-            del self.browser
-            self.browser = Browser()
-        except Exception as err:
-            sys.stderr.write(str(err))
-            sleep(60)
-            self.restart_browser()
+    def restart_browser(self, max_backoff: float = 60):
+        delay = 1
+        while True:
+            try:
+                self.backend.restart()
+                metrics.RESTARTS.inc()
+                return
+            except Exception as err:
+                sys.stderr.write('{}\n'.format(err))
+                metrics.RETRIES.inc()
+                sleep(delay)
+                delay = min(max_backoff, delay * 2)
+
+    def select_marca_input(self):
+        # quando é feita a seleção da marca Rover,
+        # estava sendo escolhida a marca Land Rover,
+        # pois está se sobrepõe a primeira
+        # por causa do select estar ordenado em ordem alfabética,
+        # assim, é necessário enviar um comando de seta para baixo
+        # para fazer a seleção correta da marca
+        # pelo nome, pois os ids das marcas dependem da ordem de inserção no banco
+        rover = self.vehicle_type == CARRO and self.marca.marca_name == 'Rover'
+        self.backend.select_marca(self.marca.marca_name, arrow_down=rover)
 
     def save_search(self):
-        try:
-            self.browser.search.click()
-            info = self.browser.search_result
-
-            self.modelo.fipe_code = info[3].text
-            self.database.save_database(self.modelo)
+        with metrics.SAVE_SEARCH.time():
+            return self._save_search()
 
-            price = float(info[15].text.replace('R$ ', '').replace('.', '').replace(',', '.'))
-            price = Price(id_referencia=self.reference.id, id_ano_modelo=self.ano.id, value=price)
-            self.database.save_database(price)
+    def _save_search(self):
+        # retorna True quando o ano está resolvido: preço salvo
+        # ou ano removido por não existir no site
+        try:
+            result = self.backend.search()
 
-            self.browser.clear.click()
-            sleep(1)
-        except ElementClickInterceptedException as err:
-            sys.stderr.write(str(err))
-            if self.browser.select_ano_result.startswith('Nada encontrado com'):
-                self.database.delete_ano(self.ano.id)
+            record = price_record(
+                self.reference, self.marca, self.modelo, self.ano, result['fipe_code'], parse_price(result['price'])
+            )
+            # o sink e o writer também marcam o ano como visitado
+            if self.writer is not None:
+                self.writer.save_price(record)
             else:
-                self.restart_browser()
-            return False
+                self.sink.write([record])
+            metrics.price_saved()
+        except CacheMiss:
+            # tratado pelo select_ano
+            raise
+        except VehicleNotFound as err:
+            sys.stderr.write('{}\n'.format(err))
+            metrics.NOT_FOUND.inc()
+            self.database.delete_ano(self.ano.id)
         except (NoSuchElementException, IndexError, Exception) as err:
-            sys.stderr.write(str(err))
+            sys.stderr.write('{}\n'.format(err))
             self.restart_browser()
             return False
         return True
 
-    def select_ano(self):
+    def select_ano(self) -> bool:
+        # os anos pendentes do modelo são carregados uma única vez;
+        # o status de cada ano é gravado pelo save_search ou pelo writer.
+        # retorna False quando algum ano ficou pendente
+        complete = True
+        anos = Frontier(lambda: self.database.get_unvisited_anos(self.modelo.id))
+
         # esse if trata a interrupção do scraper.
         # a lista de veículos será salva no banco
         # apenas quando não houver nehuma ano visitado
-        if not self.database.has_unvisited_ano():
-            print(datetime.now(), datetime.now() - start, self.modelo.modelo_name)
-            self.database.save_anos(
-                self.browser.get_option_list(self.browser.option_ano),
-                self.modelo.id,
-                self.reference.period
-            )
+        if not anos:
+            # no modo incremental os anos já conhecidos do modelo são
+            # consultados diretamente, sem listar os anos novamente
+            known = self.database.reopen_anos(self.modelo.id) if self.incremental else []
+            if not known or self.may_have_new_anos(known):
+                print(datetime.now(), datetime.now() - start, self.modelo.modelo_name)
+                self.database.save_anos(self.backend.anos(), self.modelo.id, known=set(known))
+            anos.reload()
 
         # enquanto houver ano não visitado
         # executará esse laço
-        while self.database.has_unvisited_ano():
-            # seleciona o primeiro ano do veículo
-            # não visitado do banco de dados
-            self.ano = self.database.get_unvisited_ano(self.modelo.id)
+        while anos:
+            # seleciona o primeiro ano do veículo não visitado
+            self.ano = anos.peek()
 
             try:
                 # seleciona referencia, marca modelo e ano do modelo
-                self.browser.input_send_keys(self.browser.input_ref, self.reference.text)
-                if self.marca.id == 73:
-                    self.browser.input_send_keys_with_arrow_down(
-                        self.browser.input_marca, self.marca.marca_name
-                    )
-                else:
-                    self.browser.input_send_keys(self.browser.input_marca, self.marca.marca_name)
-                self.browser.input_send_keys(self.browser.input_modelo, self.modelo.modelo_name)
-                self.browser.input_send_keys(self.browser.input_ano, self.ano.ano_modelo)
+                self.backend.select_reference(self.reference.text)
+                self.select_marca_input()
+                self.backend.select_modelo(self.modelo.modelo_name)
+                self.backend.select_ano(self.ano.ano_modelo)
+            except VehicleNotFound as err:
+                sys.stderr.write('{}\n'.format(err))
+                metrics.NOT_FOUND.inc()
+                self.database.delete_ano(self.ano.id)
+                anos.done(sync=False)
             except Exception as err:
-                sys.stderr.write(str(err))
+                sys.stderr.write('{}\n'.format(err))
                 self.restart_browser()
             else:
-                saved = self.save_search()
-                if saved:
-                    self.database.set_ano_visited(self.ano.id)
+                try:
+                    if self.save_search():
+                        anos.done(sync=False)
+                except CacheMiss as err:
+                    # no replay, o ano sem resposta gravada é pulado e continua pendente,
+                    # assim como o modelo, para uma execução com o site
+                    sys.stderr.write('{}\n'.format(err))
+                    anos.done(sync=False)
+                    complete = False
+        return complete
+
+    def may_have_new_anos(self, known: list) -> bool:
+        # só modelos ainda em produção (ano recente ou zero km)
+        # podem ganhar um ano novo de um mês para o outro
+        years = [int(ano.split(' ')[0]) for ano in known if ano.split(' ')[0].isdigit()]
+        return not years or max(years) >= self.reference.period.year - 1
+
+    def set_modelo_visited(self) -> bool:
+        # o modelo só é marcado como visitado depois que os preços dos seus
+        # anos foram gravados; retorna False se o writer descartou algum preço
+        if self.writer is not None and self.writer.drain():
+            sys.stderr.write('preços descartados; {} continua pendente\n'.format(self.modelo.modelo_name))
+            return False
+        self.database.set_modelo_visited(self.modelo.id)
+        return True
+
+    def select_modelo(self) -> bool:
+        # retorna False quando algum modelo ficou pendente;
+        # os modelos são lidos e salvos sob a mesma marca; com as chaves naturais,
+        # uma marca renomeada no site (ex.: Buggy, hoje Baby) é uma marca nova
+        modelos = Frontier(lambda: self.database.get_unvisited_modelos(self.marca.id))
 
-    def select_modelo(self):
         # esse if trata a interrupção do scraper.
         # a lista de veículos será salva no banco
         # apenas quando não houver nenhum modelo visitado
-        if not self.database.has_unvisited_modelo():
+        if not modelos:
             print(datetime.now() - start, self.marca.marca_name)
-            self.database.save_modelos(self.browser.get_option_list(self.browser.option_modelo), self.marca.id)
+            self.database.save_modelos(self.backend.modelos(), self.marca.id)
+            modelos.reload()
 
-        # enquanto houver modelos não visitados
-        # no banco de dados executa esse laço
-        while self.database.has_unvisited_modelo():
-            # seleciona um modelo não visitado do banco de dados
-            # atentando para o caso da marca Buggy que mudou de nome para Baby
-            self.modelo = self.database.get_unvisited_modelo(self.marca.id if self.marca.id != 89 else 8)
+        complete = True
+        # enquanto houver modelos não visitados executa esse laço
+        while modelos:
+            # seleciona um modelo não visitado
+            self.modelo = modelos.peek()
 
             try:
-                # sempre é feita a seleção de marca
-                # pois após a consulta de um carro
-                # todos os campos são apagados
-                self.browser.input_send_keys(self.browser.input_ref, self.reference.text)
-                if self.marca.id == 73:
-                    self.browser.input_send_keys_with_arrow_down(self.browser.input_marca, self.marca.marca_name)
-                else:
-                    self.browser.input_send_keys(self.browser.input_marca, self.marca.marca_name)
+                # a seleção é sempre pedida ao backend, que
+                # só altera os campos diferentes do formulário
+                self.backend.select_reference(self.reference.text)
+                self.select_marca_input()
                 # selciona o modelo
-                self.browser.input_send_keys(self.browser.input_modelo, self.modelo.modelo_name)
-                sleep(2)  # aguarda o carregamento do ajax
+                self.backend.select_modelo(self.modelo.modelo_name)
             except Exception as err:
-                sys.stderr.write(str(err))
+                sys.stderr.write('{}\n'.format(err))
                 self.restart_browser()
             else:
-                self.select_ano()
-
-                self.database.set_modelo_visited(self.modelo.id)
+                if not (self.select_ano() and self.set_modelo_visited()):
+                    complete = False
+                modelos.done(sync=False)
+        return complete
+
+    def select_marca(self) -> bool:
+        # retorna False quando alguma marca ficou pendente
+        complete = True
+        marcas = Frontier(
+            lambda: self.database.get_unvisited_marcas(self.reference.id),
+            lambda marca: self.database.set_marca_visited(marca.id)
+        )
 
-    def select_marca(self):
         # esse if trata a interrupção do scraper.
         # a lista de veículos será salva no banco
         # apenas quando não houver nenhuma marca visitada
-        if not self.database.has_marca_unvisited():
+        if not marcas:
             print(datetime.now() - start, self.reference.text)
-            self.database.save_marcas(self.browser.get_option_list(self.browser.option_marca), self.reference.id)
+            self.database.save_marcas(self.backend.marcas(), self.reference.id)
+            marcas.reload()
 
         # enquanto houver marcas não visitadas executará esse laço
-        while self.database.has_marca_unvisited():
-            self.marca = self.database.get_unvisted_marca(self.reference.id)
-            # quando é feita a seleção da marca Rover,
-            # estava sendo escolhida a marca Land Rover,
-            # pois está se sobrepõe a primeira
-            # por causa do select estar ordenado em ordem alfabética,
-            # assim, é necessário enviar um comando de seta para baixo
-            # para fazer a seleção correta da marca
+        while marcas:
+            self.marca = marcas.peek()
             try:
-                self.browser.input_send_keys(self.browser.input_ref, self.reference.text)
-                if self.marca.id == 73:
-                    self.browser.input_send_keys_with_arrow_down(self.browser.input_marca, self.marca.marca_name)
-                else:
-                    self.browser.input_send_keys(self.browser.input_marca, self.marca.marca_name)
-                sleep(2)  # aguarda o load do ajax
+                self.backend.select_reference(self.reference.text)
+                self.select_marca_input()
             except Exception as err:
-                sys.stderr.write(str(err))
+                sys.stderr.write('{}\n'.format(err))
                 self.restart_browser()
             else:
-                # seleciona todos
-                # os modelos dessa marca
-                self.select_modelo()
-                # marca a marca de veículos
-                # como visitada
-                self.database.set_marca_visited(self.marca.id)
+                # seleciona todos os modelos dessa marca e,
+                # se nenhum ficou pendente, marca a marca como visitada
+                if self.select_modelo():
+                    marcas.done()
+                else:
+                    marcas.done(sync=False)
+                    complete = False
+        return complete
 
-    def select_reference(self):
+    def save_references(self, vehicle_types=None):
         # pega todos os valores presentes no campo período de referencia
-        # e salva no banco de dados
-        references = self.browser.get_option_list(self.browser.option_ref)
-        self.database.save_reference(references)
+        # e salva no banco de dados, para este ou para vários tipos de veículo
+        references = self.backend.references()
+        self.database.save_reference(references, force=self.incremental, vehicle_types=vehicle_types)
+
+    def select_reference(self):
+        self.save_references()
+        self.crawl_references()
 
+    def crawl_references(self):
+        referencias = Frontier(
+            self.database.get_unvisited_references,
+            lambda reference: self.database.set_reference_visited(reference.id)
+        )
         # enquanto houver período de referência no banco de dado
         # com o valor não visitado atribuído, executará esse laço
-        while self.database.has_unvisited_reference():
-            # pega a primeira referencia do banco de dados
+        while referencias:
+            # pega a primeira referencia
             # e marca o campo período de referencia
-            self.reference = self.database.get_unvisted_reference()
-            self.browser.input_send_keys(self.browser.input_ref, self.reference.text)
-            sleep(2)  # aguarda o load do ajax
-            # faz a seleção de marcas
-            # para a referencia determinada
-            self.select_marca()
-            # marca a referencia
-            # como visitada
-            self.database.set_reference_visited(self.reference.id)
+            self.reference = referencias.peek()
+            self.backend.select_reference(self.reference.text)
+            # faz a seleção de marcas para a referencia determinada e,
+            # se nenhuma ficou pendente, marca a referencia como visitada
+            if not self.select_marca():
+                # os modelos e anos pendentes seriam tomados como uma execução
+                # interrompida na próxima referência, então param o percurso
+                sys.stderr.write('referência {} incompleta\n'.format(self.reference.text))
+                return
+            referencias.done()
 
     def run(self):
         self.select_reference()
-        self.browser.close()
+        self.close()
+
+    def close(self, writer: bool = True):
+        # writer=False mantém aberto um writer compartilhado com outras Applications
+        self.backend.close()
+        if writer and self.writer is not None:
+            self.writer.close()
+        self.sink.close()
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Scraper da tabela FIPE')
+    parser.add_argument('--backend', choices=('browser', 'http'), default='browser',
+                        help='navegador Firefox (padrão) ou consulta direta à API JSON da FIPE')
+    parser.add_argument('--api-url', default=API_URL, help='endereço da API usado pelo backend http')
+    parser.add_argument('--site-url', default=SITE_URL, help='endereço da página de consulta usada pelo navegador')
+    parser.add_argument('--vehicle-type', choices=sorted(VEHICLE_TYPES), nargs='+', default=['carro'],
+                        help='tipos de veículo consultados; com mais de um, os tipos são percorridos ao mesmo '
+                             'tempo e os preços gravados por um único writer')
+    parser.add_argument('--lean', action='store_true',
+                        help='perfil do Firefox sem imagens, fontes, CSS e scripts de análise e anúncios')
+    parser.add_argument('--profile-dir',
+                        help='diretório do perfil do modo --lean; criado na primeira execução e reaproveitado depois')
+    parser.add_argument('--spares', type=int, default=0,
+                        help='sessões reserva do Firefox mantidas abertas para trocar em caso de falha')
+    parser.add_argument('--recycle-after', type=int, default=1000,
+                        help='consultas por sessão do Firefox antes de trocá-la por uma reserva')
+    parser.add_argument('--database-url', default=ENGINE, help='url SQLAlchemy do banco de dados')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='quantidade de backends (ex.: sessões do Firefox) consultando em paralelo')
+    parser.add_argument('--incremental', action='store_true',
+                        help='atualização mensal: salva os meses novos e consulta os anos já conhecidos diretamente')
+    parser.add_argument('--reprice', nargs='?', const='', metavar='REFERENCIA',
+                        help='consulta pelo código fipe o preço dos anos já conhecidos na referência '
+                             '(padrão: a mais recente), usando --concurrency consultas simultâneas')
+    parser.add_argument('--output', metavar='ARQUIVO',
+                        help='também grava os preços em um arquivo JSONL (ou Parquet, se terminar em .parquet)')
+    parser.add_argument('--write-behind', action='store_true',
+                        help='grava os preços em lotes por uma thread dedicada')
+    parser.add_argument('--batch-size', type=int, default=200, help='preços por lote no modo --write-behind')
+    parser.add_argument('--flush-interval', type=float, default=1.0,
+                        help='tempo máximo em segundos até gravar um lote no modo --write-behind')
+    parser.add_argument('--distributed', action='store_true',
+                        help='coordena vários nós pelo banco de dados com leases por referência e marca')
+    parser.add_argument('--owner', help='identificador do nó no modo --distributed')
+    parser.add_argument('--lease-ttl', type=float, default=120, help='validade do lease em segundos')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='percorre a árvore de forma concorrente usando a API JSON')
+    parser.add_argument('--concurrency', type=int, default=8, help='requisições simultâneas no modo --async')
+    parser.add_argument('--rate', type=float, default=10, help='requisições por segundo no modo --async')
+    parser.add_argument('--fan-out', type=int, nargs=3, metavar=('MARCA', 'MODELO', 'ANO'),
+                        default=[FAN_OUT['marca'], FAN_OUT['modelo'], FAN_OUT['ano']],
+                        help='nós de cada nível expandidos ao mesmo tempo no modo --async')
+    parser.add_argument('--cache', metavar='ARQUIVO',
+                        help='grava as listas de opções e os resultados em um cache em disco e os lê dele '
+                             'antes de consultar o site')
+    parser.add_argument('--cache-ttl', type=float, default=86400, help='validade em segundos das respostas do cache')
+    parser.add_argument('--cache-size', type=int, default=1024, help='tamanho máximo do cache em MB')
+    parser.add_argument('--replay', action='store_true',
+                        help='reconstrói o banco apenas com as respostas do --cache, sem consultar o site')
+    parser.add_argument('--metrics-port', type=int,
+                        help='expõe as métricas no formato do Prometheus em http://0.0.0.0:PORTA/metrics')
+    parser.add_argument('--metrics-log', type=float, metavar='SEGUNDOS',
+                        help='escreve as métricas em JSON no stderr a cada SEGUNDOS')
+    args = parser.parse_args(args)
+    if args.output and args.workers > 1:
+        parser.error('--output não pode ser usado com --workers')
+    args.vehicle_types = [VEHICLE_TYPES[name] for name in dict.fromkeys(args.vehicle_type)]
+    if len(args.vehicle_types) > 1 and (args.workers > 1 or args.distributed):
+        parser.error('mais de um --vehicle-type não pode ser usado com --workers ou --distributed')
+    if args.replay and not args.cache:
+        parser.error('--replay requer --cache')
+    if args.replay and (args.use_async or args.reprice is not None):
+        parser.error('--replay não pode ser usado com --async ou --reprice')
+    return args
+
+
+def make_site_backend(args, vehicle_type: int = CARRO) -> CrawlBackend:
+    if args.backend == 'http':
+        return HttpBackend(FipeApi(args.api_url), vehicle_type)
+    profile = lean_profile(template_dir=args.profile_dir) if args.lean else None
+    if args.spares > 0:
+        tracker = LatencyTracker()
+        return BrowserPool(
+            lambda: Browser(tracker, profile, args.site_url, vehicle_type), args.spares, args.recycle_after
+        )
+    return Browser(profile=profile, url=args.site_url, vehicle_type=vehicle_type)
+
+
+def make_backend(args, vehicle_type: int = CARRO) -> CrawlBackend:
+    if not args.cache:
+        return metrics.InstrumentedBackend(make_site_backend(args, vehicle_type))
+    cache = open_cache(args.cache, args.cache_ttl, args.cache_size * 1024 * 1024)
+    if args.replay:
+        return metrics.InstrumentedBackend(CachingBackend(None, cache, vehicle_type, replay=True))
+    return metrics.InstrumentedBackend(CachingBackend(make_site_backend(args, vehicle_type), cache, vehicle_type))
+
+
+def make_writer(args, files: PriceSink = None) -> WriteBehind:
+    writer = WriteBehind(
+        args.database_url, batch_size=args.batch_size, flush_interval=args.flush_interval, files=files
+    ).start()
+    metrics.REGISTRY.gauge('fipe_write_queue_depth', 'Preços aguardando gravação') \
+        .set_function(writer.queue.qsize)
+    return writer
+
+
+def make_app(args, vehicle_type: int = CARRO, writer: WriteBehind = None):
+    # com `writer`, os preços vão para um writer compartilhado por várias Applications
+    database = Database(args.database_url, vehicle_type)
+    sink = None
+    if writer is None:
+        files = file_sink(args.output) if args.output else None
+        if args.write_behind:
+            writer = make_writer(args, files)
+        elif files is not None:
+            sink = MultiSink(database_sink(database), files)
+    return Application(make_backend(args, vehicle_type), database, writer, args.incremental, sink, vehicle_type)
+
+
+def crawl(args):
+    # percorre a tabela no modo escolhido pelos argumentos da linha de comando
+    if args.reprice is not None:
+        for vehicle_type in args.vehicle_types:
+            Repricer(
+                FipeApi(args.api_url), Database(args.database_url, vehicle_type),
+                workers=args.concurrency, vehicle_type=vehicle_type
+            ).run(args.reprice)
+        return
+
+    if args.use_async:
+        # cada tipo usa toda a concorrência, então são percorridos um depois do outro
+        files = file_sink(args.output) if args.output else None
+        for vehicle_type in args.vehicle_types:
+            database = Database(args.database_url, vehicle_type)
+            AsyncCrawler(
+                FipeApi(args.api_url),
+                database,
+                concurrency=args.concurrency,
+                rate=args.rate,
+                fan_out=dict(zip(('marca', 'modelo', 'ano'), args.fan_out)),
+                vehicle_type=vehicle_type,
+                sink=MultiSink(database_sink(database), files) if files is not None else None
+            ).run(close_sink=vehicle_type == args.vehicle_types[-1])
+        return
+
+    if len(args.vehicle_types) > 1:
+        writer = make_writer(args, file_sink(args.output) if args.output else None)
+        VehicleCrawl(lambda vehicle_type, shared: make_app(args, vehicle_type, shared), args.vehicle_types, writer) \
+            .run()
+        return
+
+    if args.distributed:
+        app = make_app(args, args.vehicle_types[0])
+        leases = LeaseManager(app.database, args.owner, ttl=args.lease_ttl, heartbeat=args.lease_ttl / 4)
+        CrawlNode(app, leases).run()
+        return
+
+    if args.workers > 1:
+        WorkerPool(lambda: make_app(args, args.vehicle_types[0]), args.workers).run()
+        return
+
+    app = make_app(args, args.vehicle_types[0])
+    try:
+        app.run()
+    except Exception as e:
+        sys.stderr.write('{}\n'.format(e))
+        app.close()
 
 
 if __name__ == '__main__':
 
-    app = Application()
-    try:
-        sleep(2)
-        app.run()
-    except Exception as e:
-        sys.stderr.write(str(e))
-        app.browser.close()
+    args = parse_args()
+    if args.metrics_port is not None:
+        metrics.MetricsServer(args.metrics_port).start()
+    if args.metrics_log:
+        metrics.PeriodicLogger(args.metrics_log).start()
+    crawl(args)
@@ -0,0 +1,221 @@
+import json
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from crawl_backend import CrawlBackend, VehicleNotFound
+
+API_URL = 'https://veiculos.fipe.org.br/api/veiculos/'
+
+CARRO = 1
+MOTO = 2
+CAMINHAO = 3
+
+VEHICLE_NAMES = {CARRO: 'carro', MOTO: 'moto', CAMINHAO: 'caminhao'}
+VEHICLE_TYPES = {name: code for code, name in VEHICLE_NAMES.items()}
+
+FUELS = {'Gasolina': 1, 'Álcool': 2, 'Diesel': 3}
+FUEL_NAMES = {code: name for name, code in FUELS.items()}
+
+# ano com que o site lista os veículos zero km
+ZERO_KM = 32000
+
+
+def parse_ano(label: str) -> tuple:
+    # '2015 Gasolina' -> (2015, 1); os zero km aparecem como o ano ZERO_KM
+    year, fuel = label.split(' ', 1)
+    return int(year), FUELS[fuel]
+
+
+def ano_label(year: int, fuel: int) -> str:
+    return '{} {}'.format(year, FUEL_NAMES[fuel])
+
+
+def ano_code(label: str) -> str:
+    # '2015 Gasolina' -> '2015-1', o mesmo valor usado pelo select do site
+    return '{}-{}'.format(*parse_ano(label))
+
+
+class FipeApiError(Exception):
+    pass
+
+
+class FipeApi:
+    """
+    Cliente dos endpoints JSON usados pela página de consulta da FIPE.
+    """
+
+    def __init__(self, url: str = API_URL, timeout: float = 30, recorder=None):
+        self.url = url if url.endswith('/') else url + '/'
+        self.timeout = timeout
+        self.recorder = recorder
+
+    def post(self, endpoint: str, params: dict):
+        request = Request(
+            self.url + endpoint,
+            data=urlencode(params).encode('utf-8'),
+            headers={
+                'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
+                'Referer': 'http://veiculos.fipe.org.br/',
+                'X-Requested-With': 'XMLHttpRequest',
+            }
+        )
+        with urlopen(request, timeout=self.timeout) as response:
+            data = json.loads(response.read().decode('utf-8'))
+        if self.recorder is not None:
+            self.recorder.record(endpoint, params, data)
+        if isinstance(data, dict) and 'erro' in data:
+            if data['erro'] == 'nadaencontrado':
+                raise VehicleNotFound('{} {}'.format(endpoint, params))
+            raise FipeApiError('{}: {}'.format(endpoint, data['erro']))
+        return data
+
+    def references(self) -> list:
+        return self.post('ConsultarTabelaDeReferencia', {})
+
+    def marcas(self, reference: int, vehicle_type: int = CARRO) -> list:
+        return self.post('ConsultarMarcas', {
+            'codigoTabelaReferencia': reference,
+            'codigoTipoVeiculo': vehicle_type,
+        })
+
+    def modelos(self, reference: int, marca: int, vehicle_type: int = CARRO) -> list:
+        data = self.post('ConsultarModelos', {
+            'codigoTabelaReferencia': reference,
+            'codigoTipoVeiculo': vehicle_type,
+            'codigoMarca': marca,
+        })
+        return data['Modelos']
+
+    def anos(self, reference: int, marca: int, modelo: int, vehicle_type: int = CARRO) -> list:
+        return self.post('ConsultarAnoModelo', {
+            'codigoTabelaReferencia': reference,
+            'codigoTipoVeiculo': vehicle_type,
+            'codigoMarca': marca,
+            'codigoModelo': modelo,
+        })
+
+    def price(self, reference: int, marca: int, modelo: int, ano: str, vehicle_type: int = CARRO) -> dict:
+        # o valor do ano vem no formato '2015-1', ano e código do combustível
+        year, fuel = ano.split('-')
+        return self.post('ConsultarValorComTodosParametros', {
+            'codigoTabelaReferencia': reference,
+            'codigoTipoVeiculo': vehicle_type,
+            'codigoMarca': marca,
+            'codigoModelo': modelo,
+            'anoModelo': year,
+            'codigoTipoCombustivel': fuel,
+            'tipoVeiculo': VEHICLE_NAMES[vehicle_type],
+            'modeloCodigoExterno': '',
+            'tipoConsulta': 'tradicional',
+        })
+
+    def price_by_code(self, reference: int, fipe_code: str, ano: str, vehicle_type: int = CARRO) -> dict:
+        # consulta por código fipe, sem precisar dos códigos de marca e modelo
+        year, fuel = ano.split('-')
+        return self.post('ConsultarValorComTodosParametros', {
+            'codigoTabelaReferencia': reference,
+            'codigoTipoVeiculo': vehicle_type,
+            'codigoMarca': '',
+            'codigoModelo': '',
+            'anoModelo': year,
+            'codigoTipoCombustivel': fuel,
+            'tipoVeiculo': VEHICLE_NAMES[vehicle_type],
+            'modeloCodigoExterno': fipe_code,
+            'tipoConsulta': 'codigo',
+        })
+
+
+class HttpBackend(CrawlBackend):
+    """
+    Backend que consulta diretamente a API JSON da FIPE, sem navegador.
+    Guarda o mapeamento texto -> código de cada lista consultada, pois
+    a Application trabalha apenas com os textos salvos no banco.
+    """
+
+    def __init__(self, api: FipeApi = None, vehicle_type: int = CARRO):
+        self.api = api if api is not None else FipeApi()
+        self.vehicle_type = vehicle_type
+        self.reference = None
+        self.marca = None
+        self.modelo = None
+        self.ano = None
+        self._codes = {}
+
+    def _options(self, level: str, key: tuple, fetch) -> list:
+        if (level, key) not in self._codes:
+            self._codes[(level, key)] = {
+                str(item['Label']).strip(): item['Value'] for item in fetch()
+            }
+        return list(self._codes[(level, key)])
+
+    def _code(self, level: str, key: tuple, fetch, label: str):
+        self._options(level, key, fetch)
+        codes = self._codes[(level, key)]
+        if label not in codes:
+            # a lista pode ter mudado desde a última consulta
+            del self._codes[(level, key)]
+            self._options(level, key, fetch)
+            codes = self._codes[(level, key)]
+        try:
+            return codes[label]
+        except KeyError:
+            raise VehicleNotFound('{} {} não encontrado'.format(level, label))
+
+    def _fetch_references(self):
+        return [{'Label': item['Mes'], 'Value': item['Codigo']} for item in self.api.references()]
+
+    def _fetch_marcas(self):
+        return self.api.marcas(self.reference, self.vehicle_type)
+
+    def _fetch_modelos(self):
+        return self.api.modelos(self.reference, self.marca, self.vehicle_type)
+
+    def _fetch_anos(self):
+        return self.api.anos(self.reference, self.marca, self.modelo, self.vehicle_type)
+
+    def references(self) -> list:
+        return self._options('reference', (), self._fetch_references)
+
+    def marcas(self) -> list:
+        return self._options('marca', (self.reference,), self._fetch_marcas)
+
+    def modelos(self) -> list:
+        return self._options('modelo', (self.reference, self.marca), self._fetch_modelos)
+
+    def anos(self) -> list:
+        return self._options('ano', (self.reference, self.marca, self.modelo), self._fetch_anos)
+
+    def select_reference(self, reference: str):
+        self.reference = self._code('reference', (), self._fetch_references, reference)
+        self.marca = self.modelo = self.ano = None
+
+    def select_marca(self, marca: str, arrow_down: bool = False):
+        self.marca = self._code('marca', (self.reference,), self._fetch_marcas, marca)
+        self.modelo = self.ano = None
+
+    def select_modelo(self, modelo: str):
+        self.modelo = self._code('modelo', (self.reference, self.marca), self._fetch_modelos, modelo)
+        self.ano = None
+
+    def select_ano(self, ano: str):
+        key = (self.reference, self.marca, self.modelo)
+        if ('ano', key) not in self._codes:
+            # o código do ano é derivado do texto, sem consultar a lista de anos
+            try:
+                self.ano = ano_code(ano)
+                return
+            except (KeyError, ValueError):
+                pass
+        self.ano = self._code('ano', key, self._fetch_anos, ano)
+
+    def search(self) -> dict:
+        result = self.api.price(self.reference, self.marca, self.modelo, self.ano, self.vehicle_type)
+        return {
+            'fipe_code': result['CodigoFipe'],
+            'price': result['Valor'],
+            'reference': result.get('MesReferencia', '').strip(),
+            'authentication': result.get('Autenticacao'),
+        }
+
+    def restart(self):
+        self._codes = {}
@@ -0,0 +1,80 @@
+import os
+import shutil
+from urllib.parse import quote
+
+from selenium.webdriver import FirefoxProfile
+
+# domínios de análise e anúncios carregados pela página da FIPE
+BLOCKED_DOMAINS = (
+    'google-analytics.com',
+    'googletagmanager.com',
+    'googleadservices.com',
+    'googlesyndication.com',
+    'doubleclick.net',
+    'facebook.net',
+    'facebook.com',
+    'hotjar.com',
+    'addthis.com',
+    'twitter.com',
+    'youtube.com',
+)
+
+COMMON_PREFERENCES = {
+    'browser.cache.disk.enable': False,
+    'browser.sessionhistory.max_entries': 2,
+    'browser.shell.checkDefaultBrowser': False,
+    'network.prefetch-next': False,
+    'network.dns.disablePrefetch': True,
+    'network.http.speculative-parallel-limit': 0,
+    'media.autoplay.enabled': False,
+    'datareporting.healthreport.uploadEnabled': False,
+    'datareporting.policy.dataSubmissionEnabled': False,
+    'toolkit.telemetry.enabled': False,
+    'app.update.enabled': False,
+    'extensions.update.enabled': False,
+}
+
+
+def blocklist_pac(domains) -> str:
+    # envia os domínios bloqueados para um proxy inexistente e o resto direto
+    rules = ' || '.join('dnsDomainIs(host, "{}")'.format(domain) for domain in domains)
+    return 'function FindProxyForURL(url, host) {{ if ({}) return "PROXY 127.0.0.1:9"; return "DIRECT"; }}'.format(
+        rules or 'false'
+    )
+
+
+def lean_profile(images: bool = True, fonts: bool = True, stylesheets: bool = True,
+                 domains=BLOCKED_DOMAINS, template_dir: str = None) -> FirefoxProfile:
+    """
+    Perfil do Firefox que não baixa nem renderiza o que o scraper não lê.
+    Com `template_dir`, o perfil é salvo nesse diretório na primeira vez, por
+    save_template, e reaproveitado nas seguintes.
+    """
+    if template_dir is not None:
+        if not os.path.isdir(template_dir):
+            save_template(template_dir, images=images, fonts=fonts, stylesheets=stylesheets, domains=domains)
+        return FirefoxProfile(template_dir)
+
+    profile = FirefoxProfile()
+    for name, value in COMMON_PREFERENCES.items():
+        profile.set_preference(name, value)
+    if images:
+        profile.set_preference('permissions.default.image', 2)
+    if fonts:
+        profile.set_preference('browser.display.use_document_fonts', 0)
+        profile.set_preference('gfx.downloadable_fonts.enabled', False)
+    if stylesheets:
+        profile.set_preference('permissions.default.stylesheet', 2)
+    if domains:
+        profile.set_preference('network.proxy.type', 2)
+        profile.set_preference('network.proxy.autoconfig_url', 'data:text/plain,' + quote(blocklist_pac(domains)))
+    profile.update_preferences()
+    return profile
+
+
+def save_template(path: str, **kwargs) -> str:
+    profile = lean_profile(**kwargs)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    shutil.copytree(profile.path, path)
+    return path
@@ -0,0 +1,33 @@
+from collections import deque
+
+
+class Frontier:
+    """
+    Fila em memória com o trabalho pendente de um nó da árvore (ex.: os anos
+    não visitados de um modelo). As linhas são carregadas do banco uma única vez
+    por `load`; `done` retira a primeira da fila e, se informado, chama `visited`
+    para gravar o novo status no banco.
+    """
+
+    def __init__(self, load, visited=None):
+        self.load = load
+        self.visited = visited
+        self.pending = deque(load())
+
+    def __bool__(self):
+        return bool(self.pending)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def reload(self):
+        self.pending = deque(self.load())
+
+    def peek(self):
+        return self.pending[0] if self.pending else None
+
+    def done(self, sync: bool = True):
+        row = self.pending.popleft()
+        if sync and self.visited is not None:
+            self.visited(row)
+        return row
@@ -0,0 +1,284 @@
+import socket
+import sys
+import threading
+import uuid
+from datetime import datetime, timedelta
+from time import sleep
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+from db_declarative import UNVISITED, VISITED, VISITING, CrawlLease, Database, MarcaReferencia
+from fipe_api import VEHICLE_NAMES
+from frontier import Frontier
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def default_owner() -> str:
+    return '{}-{}'.format(socket.gethostname(), uuid.uuid4().hex[:8])
+
+
+class LeaseManager:
+    """
+    Coordena nós do scraper que compartilham o mesmo banco de dados.
+    O trabalho é dividido em shards (ex.: referência e marca) e cada shard
+    só é processado pelo dono de um lease válido. Leases expirados, de nós
+    que pararam de enviar heartbeat, são retomados por outro nó, que continua
+    a marca pelos modelos ainda não visitados.
+
+    Os horários são gravados em UTC pelo relógio de cada nó, que devem estar sincronizados.
+    """
+
+    def __init__(self, database: Database, owner: str = None, ttl: float = 120, heartbeat: float = 30):
+        self.database = database
+        self.owner = owner if owner is not None else default_owner()
+        self.ttl = timedelta(seconds=ttl)
+        self.heartbeat_interval = heartbeat
+
+    @property
+    def session(self):
+        return self.database.session
+
+    def ensure(self, shard: str, reference_id: int = None, marca_id: int = None):
+        if self.session.query(CrawlLease).filter(CrawlLease.shard == shard).count():
+            return
+        try:
+            self.session.add(CrawlLease(shard=shard, reference_id=reference_id, marca_id=marca_id, status=UNVISITED))
+            self.session.commit()
+        except IntegrityError:
+            # outro nó criou o shard ao mesmo tempo
+            self.session.rollback()
+
+    def _available(self, now: datetime):
+        return or_(
+            CrawlLease.status == UNVISITED,
+            (CrawlLease.status == VISITING) & (CrawlLease.expires_at < now)
+        )
+
+    def _take(self, lease: CrawlLease, now: datetime):
+        taken = self.session.query(CrawlLease) \
+            .filter(CrawlLease.id == lease.id, self._available(now)) \
+            .update({
+                CrawlLease.status: VISITING,
+                CrawlLease.owner: self.owner,
+                CrawlLease.expires_at: now + self.ttl,
+                CrawlLease.heartbeat_at: now,
+                CrawlLease.attempts: CrawlLease.attempts + 1,
+            }, synchronize_session=False)
+        self.session.commit()
+        if not taken:
+            return None
+        self.session.refresh(lease)
+        return lease
+
+    def acquire(self, shard: str = None, reference_id: int = None):
+        now = datetime.utcnow()
+        query = self.session.query(CrawlLease).filter(self._available(now))
+        if shard is not None:
+            query = query.filter(CrawlLease.shard == shard)
+        if reference_id is not None:
+            query = query.filter(CrawlLease.reference_id == reference_id, CrawlLease.marca_id.isnot(None))
+        for lease in query.order_by(CrawlLease.id).limit(10).all():
+            taken = self._take(lease, now)
+            if taken is not None:
+                return taken
+        return None
+
+    def renew(self, lease_id: int, session=None):
+        # recebe apenas o id, pois é chamado pela thread do heartbeat com outra sessão
+        session = session if session is not None else self.session
+        now = datetime.utcnow()
+        renewed = session.query(CrawlLease) \
+            .filter(CrawlLease.id == lease_id, CrawlLease.owner == self.owner, CrawlLease.status == VISITING) \
+            .update({CrawlLease.expires_at: now + self.ttl, CrawlLease.heartbeat_at: now},
+                    synchronize_session=False)
+        session.commit()
+        if not renewed:
+            raise LeaseLost(lease_id)
+
+    def _finish(self, lease: CrawlLease, status: int):
+        self.session.query(CrawlLease) \
+            .filter(CrawlLease.id == lease.id, CrawlLease.owner == self.owner) \
+            .update({CrawlLease.status: status, CrawlLease.owner: None, CrawlLease.expires_at: None},
+                    synchronize_session=False)
+        self.session.commit()
+
+    def complete(self, lease: CrawlLease):
+        self._finish(lease, VISITED)
+
+    def release(self, lease: CrawlLease):
+        self._finish(lease, UNVISITED)
+
+    def is_done(self, shard: str) -> bool:
+        return self.session.query(CrawlLease) \
+            .filter(CrawlLease.shard == shard, CrawlLease.status == VISITED).count() > 0
+
+    def pending(self, reference_id: int) -> int:
+        return self.session.query(CrawlLease) \
+            .filter(CrawlLease.reference_id == reference_id, CrawlLease.marca_id.isnot(None),
+                    CrawlLease.status != VISITED).count()
+
+    def heartbeat(self, lease: CrawlLease):
+        return Heartbeat(self, lease)
+
+
+class Heartbeat:
+    """
+    Renova o lease em segundo plano, com uma sessão própria, enquanto o shard
+    é processado. Se o lease for perdido, `lost` é marcado e o processamento
+    deve ser interrompido sem concluir o shard.
+    """
+
+    def __init__(self, manager: LeaseManager, lease: CrawlLease):
+        # o objeto do ORM pertence à sessão da thread principal e não é usado pela thread do heartbeat
+        self.manager = manager
+        self.lease_id = lease.id
+        self.shard = lease.shard
+        self.lost = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        session = sessionmaker(bind=self.manager.database.engine)()
+        try:
+            while not self.stopped.wait(self.manager.heartbeat_interval):
+                try:
+                    self.manager.renew(self.lease_id, session)
+                except LeaseLost:
+                    self.lost.set()
+                    return
+                except Exception as err:
+                    sys.stderr.write('{}\n'.format(err))
+                    session.rollback()
+        finally:
+            session.close()
+
+    def check(self):
+        if self.lost.is_set():
+            raise LeaseLost(self.shard)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+class CrawlNode:
+    """
+    Nó do scraper distribuído. Cada referência tem um shard para a listagem
+    das marcas e um shard por marca; o nó reserva um shard por vez e o
+    percorre usando a Application informada.
+    """
+
+    def __init__(self, app, leases: LeaseManager, poll: float = 10):
+        self.app = app
+        self.leases = leases
+        self.poll = poll
+
+    @property
+    def database(self):
+        return self.app.database
+
+    def run_shard(self, shard: str, job, reference_id: int = None):
+        # processa o shard ou aguarda o nó que o reservou terminar
+        self.leases.ensure(shard, reference_id)
+        while not self.leases.is_done(shard):
+            lease = self.leases.acquire(shard=shard)
+            if lease is None:
+                sleep(self.poll)
+                continue
+            with self.leases.heartbeat(lease):
+                job()
+            self.leases.complete(lease)
+
+    def list_references(self):
+        self.database.save_reference(self.app.backend.references())
+
+    def list_marcas(self):
+        reference = self.app.reference
+        self.app.backend.select_reference(reference.text)
+        self.database.save_marcas(self.app.backend.marcas(), reference.id)
+        marcas = self.database.session.query(MarcaReferencia) \
+            .filter(MarcaReferencia.reference_id == reference.id).all()
+        for marca in marcas:
+            self.leases.ensure('{}:{}'.format(reference.id, marca.marca_id), reference.id, marca.marca_id)
+
+    def crawl_marca(self, heartbeat: Heartbeat) -> bool:
+        # retorna False quando algum modelo ficou pendente
+        app = self.app
+        complete = True
+        modelos = Frontier(lambda: self.database.get_unvisited_modelos(app.marca.id))
+        if not modelos:
+            app.backend.select_reference(app.reference.text)
+            app.select_marca_input()
+            self.database.save_modelos(app.backend.modelos(), app.marca.id)
+            modelos.reload()
+
+        while modelos:
+            heartbeat.check()
+            app.modelo = modelos.peek()
+            try:
+                app.backend.select_reference(app.reference.text)
+                app.select_marca_input()
+                app.backend.select_modelo(app.modelo.modelo_name)
+            except Exception as err:
+                sys.stderr.write('{}\n'.format(err))
+                app.restart_browser()
+            else:
+                if not (app.select_ano() and app.set_modelo_visited()):
+                    complete = False
+                modelos.done(sync=False)
+        return complete
+
+    def crawl_reference(self) -> bool:
+        # retorna False quando uma marca ficou pendente
+        reference = self.app.reference
+        self.run_shard(str(reference.id), self.list_marcas, reference.id)
+        while True:
+            lease = self.leases.acquire(reference_id=reference.id)
+            if lease is None:
+                if not self.leases.pending(reference.id):
+                    break
+                # os shards restantes estão com outros nós; aguarda terminarem ou expirarem
+                sleep(self.poll)
+                continue
+            self.app.marca = self.database.get_marca(lease.marca_id)
+            try:
+                with self.leases.heartbeat(lease) as heartbeat:
+                    complete = self.crawl_marca(heartbeat)
+            except LeaseLost as err:
+                sys.stderr.write('lease perdido: {}\n'.format(err))
+                continue
+            except Exception as err:
+                sys.stderr.write('{}\n'.format(err))
+                self.leases.release(lease)
+                self.app.restart_browser()
+                continue
+            if not complete:
+                # o shard volta a ficar disponível e os modelos pendentes ficam para a próxima execução
+                self.leases.release(lease)
+                return False
+            self.database.set_marca_visited(lease.marca_id)
+            self.leases.complete(lease)
+        self.database.set_reference_visited(reference.id)
+        return True
+
+    def run(self):
+        # a lista de referências é salva uma vez por dia para cada tipo de veículo
+        shard = 'referencias:{}:{}'.format(VEHICLE_NAMES[self.database.vehicle_type], datetime.utcnow().date())
+        self.run_shard(shard, self.list_references)
+        try:
+            while self.database.has_unvisited_reference():
+                self.app.reference = self.database.get_unvisted_reference()
+                if not self.crawl_reference():
+                    sys.stderr.write('referência {} incompleta\n'.format(self.app.reference.text))
+                    break
+        finally:
+            self.app.close()
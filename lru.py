@@ -0,0 +1,94 @@
+import threading
+from collections import OrderedDict
+
+from metrics import REGISTRY
+
+_MISSING = object()
+
+
+class LruCache:
+    """
+    Dicionário limitado a `max_size` itens que descarta o usado há mais tempo.
+    Pode ser compartilhado entre threads. Com `name`, os acertos, as falhas e
+    os descartes são publicados nas métricas como fipe_cache_*{cache=name}.
+    """
+
+    def __init__(self, max_size: int = 100000, name: str = None):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.metrics = None
+        if name is not None:
+            self.metrics = (
+                REGISTRY.counter('fipe_cache_hits_total', 'Consultas respondidas pelo cache', cache=name),
+                REGISTRY.counter('fipe_cache_misses_total', 'Consultas que não estavam no cache', cache=name),
+                REGISTRY.counter('fipe_cache_evictions_total', 'Itens descartados por falta de espaço', cache=name),
+            )
+            REGISTRY.gauge('fipe_cache_size', 'Itens no cache', cache=name).set_function(self.__len__)
+            REGISTRY.gauge('fipe_cache_hit_rate', 'Fração das consultas respondidas pelo cache', cache=name) \
+                .set_function(lambda: self.hit_rate)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def _count(self, hits: int, misses: int, evictions: int = 0):
+        self.hits += hits
+        self.misses += misses
+        self.evictions += evictions
+        if self.metrics is not None:
+            for counter, value in zip(self.metrics, (hits, misses, evictions)):
+                if value:
+                    counter.inc(value)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.items.get(key, _MISSING)
+            if value is _MISSING:
+                self._count(0, 1)
+                return default
+            self.items.move_to_end(key)
+            self._count(1, 0)
+            return value
+
+    def get_many(self, keys) -> dict:
+        # {chave: valor} das chaves presentes no cache
+        found = {}
+        with self.lock:
+            for key in keys:
+                value = self.items.get(key, _MISSING)
+                if value is not _MISSING:
+                    self.items.move_to_end(key)
+                    found[key] = value
+            self._count(len(found), len(keys) - len(found))
+        return found
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def put_many(self, items: dict):
+        with self.lock:
+            for key, value in items.items():
+                self.items[key] = value
+                self.items.move_to_end(key)
+            evicted = 0
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+                evicted += 1
+            if evicted:
+                self._count(0, 0, evicted)
+
+    def discard(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
@@ -0,0 +1,321 @@
+import json
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from crawl_backend import CrawlBackend
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in sorted(labels.items())) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name: str, labels: dict):
+        yield name, labels, self.value
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value: float):
+        self.value = value
+
+    def set_function(self, function):
+        # o valor é lido na hora da coleta, ex.: tamanho de uma fila
+        self.function = function
+
+    def get(self) -> float:
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return float('nan')
+        return self.value
+
+    def samples(self, name: str, labels: dict):
+        yield name, labels, self.get()
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, buckets=BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        with self.lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        begin = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - begin)
+
+    def samples(self, name: str, labels: dict):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            yield name + '_bucket', dict(labels, le='+Inf' if bound == float('inf') else bound), cumulative
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, self.count
+
+
+class RateMeter(Gauge):
+    """
+    Eventos por minuto na última janela de `window` segundos.
+    """
+
+    def __init__(self, window: float = 60):
+        super().__init__()
+        self.window = window
+        self.events = deque()
+        self.lock = threading.Lock()
+
+    def mark(self, amount: int = 1):
+        now = time.monotonic()
+        with self.lock:
+            self.events.append((now, amount))
+            self._expire(now)
+
+    def _expire(self, now: float):
+        while self.events and self.events[0][0] < now - self.window:
+            self.events.popleft()
+
+    def get(self) -> float:
+        with self.lock:
+            self._expire(time.monotonic())
+            return sum(amount for _, amount in self.events) * 60.0 / self.window
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.help = {}
+
+    def _get(self, cls, name: str, help: str, labels: dict, **kwargs):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            if key not in self.metrics:
+                self.metrics[key] = cls(**kwargs)
+                self.help.setdefault(name, (help, cls.kind))
+            return self.metrics[key]
+
+    def counter(self, name: str, help: str = '', **labels) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str = '', **labels) -> Gauge:
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name: str, help: str = '', buckets=BUCKETS, **labels) -> Histogram:
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def rate(self, name: str, help: str = '', window: float = 60, **labels) -> RateMeter:
+        return self._get(RateMeter, name, help, labels, window=window)
+
+    def render(self) -> str:
+        # formato texto de exposição do Prometheus
+        lines = []
+        with self.lock:
+            items = sorted(self.metrics.items(), key=lambda item: item[0])
+        seen = set()
+        for (name, labels), metric in items:
+            if name not in seen:
+                seen.add(name)
+                help, kind = self.help[name]
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} {}'.format(name, kind))
+            for sample, sample_labels, value in metric.samples(name, dict(labels)):
+                lines.append('{}{} {}'.format(sample, _labels(sample_labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict:
+        snapshot = {}
+        with self.lock:
+            items = list(self.metrics.items())
+        for (name, labels), metric in items:
+            key = name + _labels(dict(labels))
+            if isinstance(metric, Histogram):
+                snapshot[key] = {'count': metric.count, 'sum': round(metric.sum, 6)}
+            elif isinstance(metric, Gauge):
+                snapshot[key] = metric.get()
+            else:
+                snapshot[key] = metric.value
+        return snapshot
+
+
+REGISTRY = Registry()
+
+PRICES = REGISTRY.counter('fipe_prices_total', 'Preços consultados e gravados')
+PRICES_PER_MINUTE = REGISTRY.rate('fipe_prices_per_minute', 'Preços por minuto no último minuto')
+NOT_FOUND = REGISTRY.counter('fipe_not_found_total', 'Anos que não existem mais no site')
+RETRIES = REGISTRY.counter('fipe_retries_total', 'Novas tentativas depois de um erro')
+RESTARTS = REGISTRY.counter('fipe_restarts_total', 'Reinícios do backend')
+SAVE_SEARCH = REGISTRY.histogram('fipe_save_search_seconds', 'Duração da consulta e gravação de um preço')
+
+
+def price_saved(count: int = 1):
+    PRICES.inc(count)
+    PRICES_PER_MINUTE.mark(count)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int, host: str = '0.0.0.0', registry: Registry = REGISTRY):
+        super().__init__((host, port), MetricsHandler)
+        self.registry = registry
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='metrics', daemon=True).start()
+        return self
+
+
+class PeriodicLogger(threading.Thread):
+    """
+    Escreve um snapshot das métricas em JSON, uma linha a cada `interval` segundos.
+    """
+
+    def __init__(self, interval: float = 60, stream=None, registry: Registry = REGISTRY):
+        super().__init__(name='metrics-log', daemon=True)
+        self.interval = interval
+        self.stream = stream if stream is not None else sys.stderr
+        self.registry = registry
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.log()
+
+    def log(self):
+        line = dict(self.registry.snapshot(), time=time.time())
+        self.stream.write(json.dumps(line, sort_keys=True) + '\n')
+        self.stream.flush()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def instrument_engine(engine, registry: Registry = REGISTRY):
+    # mede cada comando e cada commit enviados ao banco
+    from sqlalchemy import event
+
+    statements = registry.histogram('fipe_db_statement_seconds', 'Duração dos comandos SQL')
+    commits = registry.counter('fipe_db_commits_total', 'Commits no banco de dados')
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('fipe_query_start', []).append(time.monotonic())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after(conn, cursor, statement, parameters, context, executemany):
+        statements.observe(time.monotonic() - conn.info['fipe_query_start'].pop())
+
+    @event.listens_for(engine, 'commit')
+    def commit(conn):
+        commits.inc()
+
+    return engine
+
+
+class InstrumentedBackend(CrawlBackend):
+    """
+    Mede a latência e os erros de cada chamada feita a outro backend.
+    """
+
+    def __init__(self, backend: CrawlBackend, registry: Registry = REGISTRY):
+        self.backend = backend
+        self.registry = registry
+
+    def call(self, action: str, *args, **kwargs):
+        histogram = self.registry.histogram('fipe_backend_seconds', 'Duração das ações do backend', action=action)
+        begin = time.monotonic()
+        try:
+            return getattr(self.backend, action)(*args, **kwargs)
+        except Exception:
+            self.registry.counter('fipe_backend_errors_total', 'Erros nas ações do backend', action=action).inc()
+            raise
+        finally:
+            histogram.observe(time.monotonic() - begin)
+
+    def references(self) -> list:
+        return self.call('references')
+
+    def marcas(self) -> list:
+        return self.call('marcas')
+
+    def modelos(self) -> list:
+        return self.call('modelos')
+
+    def anos(self) -> list:
+        return self.call('anos')
+
+    def select_reference(self, reference: str):
+        self.call('select_reference', reference)
+
+    def select_marca(self, marca: str, arrow_down: bool = False):
+        self.call('select_marca', marca, arrow_down)
+
+    def select_modelo(self, modelo: str):
+        self.call('select_modelo', modelo)
+
+    def select_ano(self, ano: str):
+        self.call('select_ano', ano)
+
+    def search(self) -> dict:
+        return self.call('search')
+
+    def restart(self):
+        self.call('restart')
+
+    def close(self):
+        self.backend.close()
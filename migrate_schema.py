@@ -0,0 +1,168 @@
+"""
+Migração única do banco do scraper para o esquema com chaves naturais:
+
+- ano_modelo passa a guardar o ano e o combustível como inteiros, sem as
+  colunas de texto ano_modelo e modelo, e tem um registro por modelo e ano;
+- referencia, modelo, marca_referencia e price deixam de ter duplicatas e
+  ganham os índices únicos usados pelos upserts;
+- referencia e marca ganham o tipo de veículo, e os registros existentes
+  ficam como carros.
+
+As duplicatas são unidas em um único registro e as referências a elas são
+redirecionadas. Se algum texto de ano não puder ser convertido, nada é
+alterado e os textos são listados. Pode ser executada mais de uma vez.
+
+uso: python migrate_schema.py [URL]
+"""
+import sys
+
+from sqlalchemy import SMALLINT, Column, MetaData, Table, and_, bindparam, func, inspect, select, text
+
+from db_declarative import ENGINE, Base, Marca, create_indexes, get_engine
+from fipe_api import CARRO, parse_ano
+
+# índices substituídos pelos índices únicos de db_declarative
+OLD_INDEXES = ('ix_marca_referencia_reference_marca', 'ux_referencia_period')
+
+
+class MigrationError(Exception):
+    pass
+
+
+def _table(connection, name: str, *columns) -> Table:
+    return Table(name, MetaData(), *columns, autoload=True, autoload_with=connection)
+
+
+def _anos(connection) -> Table:
+    # no SQLite a coluna year continua declarada como DATE depois da conversão
+    return _table(connection, 'ano_modelo', Column('year', SMALLINT))
+
+
+def deduplicate(connection, table: Table, keys: tuple, references=(), keep=func.min) -> int:
+    # mantém um registro por chave e aponta as referências dos demais para ele
+    key_columns = [table.c[key] for key in keys]
+    groups = connection.execute(
+        select([keep(table.c.id)] + key_columns).group_by(*key_columns).having(func.count() > 1)
+    ).fetchall()
+    removed = 0
+    for row in groups:
+        kept = row[0]
+        same_key = and_(*[column == value for column, value in zip(key_columns, row[1:])])
+        ids = [row_id for row_id, in connection.execute(select([table.c.id]).where(and_(same_key, table.c.id != kept)))]
+        for reference, column in references:
+            connection.execute(reference.update().where(reference.c[column].in_(ids)).values({column: kept}))
+        connection.execute(table.delete().where(table.c.id.in_(ids)))
+        removed += len(ids)
+    return removed
+
+
+def convert_anos(connection) -> int:
+    # preenche year e fuel a partir do texto do ano; devolve os anos convertidos.
+    # os textos são lidos antes de qualquer alteração, para que um texto desconhecido
+    # interrompa a migração sem apagar anos ou preços
+    postgres = connection.dialect.name == 'postgresql'
+    columns = {column['name'] for column in inspect(connection).get_columns('ano_modelo')}
+    if 'ano_modelo' not in columns:
+        return 0
+    labels = _table(connection, 'ano_modelo')
+    rows, invalid = [], set()
+    for ano_id, label in connection.execute(select([labels.c.id, labels.c.ano_modelo])):
+        try:
+            year, fuel = parse_ano(label)
+        except (AttributeError, KeyError, ValueError):
+            invalid.add(label)
+            continue
+        rows.append({'_id': ano_id, 'year': year, 'fuel': fuel})
+    if invalid:
+        raise MigrationError('anos que não podem ser convertidos: {}'.format(
+            ', '.join(sorted(repr(label) for label in invalid))
+        ))
+
+    if 'fuel' not in columns:
+        connection.execute(text('ALTER TABLE ano_modelo ADD COLUMN fuel SMALLINT'))
+    if postgres:
+        # os valores são recalculados abaixo a partir do texto
+        connection.execute(text('ALTER TABLE ano_modelo ALTER COLUMN year TYPE SMALLINT USING NULL'))
+        connection.execute(text('ALTER TABLE ano_modelo ALTER COLUMN status TYPE SMALLINT'))
+
+    anos = _anos(connection)
+    if rows:
+        connection.execute(
+            anos.update().where(anos.c.id == bindparam('_id')).values(year=bindparam('year'), fuel=bindparam('fuel')),
+            rows
+        )
+    connection.execute(text('ALTER TABLE ano_modelo DROP COLUMN ano_modelo'))
+    connection.execute(text('ALTER TABLE ano_modelo DROP COLUMN modelo'))
+    if postgres:
+        for column in ('year', 'fuel', 'modelo_id'):
+            connection.execute(text('ALTER TABLE ano_modelo ALTER COLUMN {} SET NOT NULL'.format(column)))
+    return len(rows)
+
+
+def add_vehicle_type(connection):
+    # a coluna entra com o valor CARRO e o nome da marca deixa de ser único sozinho
+    for table in ('referencia', 'marca'):
+        columns = {column['name'] for column in inspect(connection).get_columns(table)}
+        if 'vehicle_type' not in columns:
+            connection.execute(text(
+                'ALTER TABLE {} ADD COLUMN vehicle_type SMALLINT NOT NULL DEFAULT {}'.format(table, CARRO)
+            ))
+    unique = [constraint for constraint in inspect(connection).get_unique_constraints('marca')
+              if constraint['column_names'] == ['marca_name']]
+    if not unique:
+        return
+    if connection.dialect.name != 'sqlite':
+        for constraint in unique:
+            connection.execute(text('ALTER TABLE marca DROP CONSTRAINT {}'.format(constraint['name'])))
+        return
+    # o SQLite não remove constraints; a tabela é recriada com os mesmos ids. A nova
+    # é renomeada, e não a antiga, para que as chaves estrangeiras de modelo continuem em marca
+    columns = ', '.join(column.name for column in Marca.__table__.columns)
+    Marca.__table__.tometadata(MetaData(), name='marca_new').create(connection)
+    connection.execute(text('INSERT INTO marca_new ({0}) SELECT {0} FROM marca'.format(columns)))
+    connection.execute(text('DROP TABLE marca'))
+    connection.execute(text('ALTER TABLE marca_new RENAME TO marca'))
+
+
+def migrate(url: str = ENGINE) -> dict:
+    engine = get_engine(url)
+    Base.metadata.create_all(engine)
+    report = {}
+    with engine.begin() as connection:
+        tables = set(inspect(connection).get_table_names())
+        report['converted_anos'] = convert_anos(connection)
+        add_vehicle_type(connection)
+
+        referencia = _table(connection, 'referencia')
+        modelo = _table(connection, 'modelo')
+        marca_referencia = _table(connection, 'marca_referencia')
+        ano_modelo = _anos(connection)
+        price = _table(connection, 'price')
+
+        references = [(marca_referencia, 'reference_id'), (price, 'id_referencia')]
+        if 'crawl_lease' in tables:
+            references.append((_table(connection, 'crawl_lease'), 'reference_id'))
+        report['referencia'] = deduplicate(connection, referencia, ('vehicle_type', 'period'), references)
+        report['modelo'] = deduplicate(connection, modelo, ('marca_id', 'modelo_name'), [(ano_modelo, 'modelo_id')])
+        report['marca_referencia'] = deduplicate(connection, marca_referencia, ('reference_id', 'marca_id'))
+        # entre os anos repetidos fica o mais recente, que tem o status atual
+        report['ano_modelo'] = deduplicate(
+            connection, ano_modelo, ('modelo_id', 'year', 'fuel'), [(price, 'id_ano_modelo')], keep=func.max
+        )
+        # entre os preços repetidos fica o último gravado
+        latest = select([func.max(price.c.id)]).group_by(price.c.id_ano_modelo, price.c.id_referencia)
+        report['price'] = connection.execute(price.delete().where(~price.c.id.in_(latest))).rowcount
+
+        for name in OLD_INDEXES:
+            connection.execute(text('DROP INDEX IF EXISTS {}'.format(name)))
+    create_indexes(engine)
+    return report
+
+
+if __name__ == '__main__':
+    try:
+        report = migrate(sys.argv[1] if len(sys.argv) > 1 else ENGINE)
+    except MigrationError as err:
+        sys.exit(str(err))
+    for name, count in report.items():
+        print(name, count)
@@ -0,0 +1,455 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qsl
+
+NOT_FOUND = {'codigo': '0', 'erro': 'nadaencontrado'}
+
+MONTH_NAMES = ('janeiro', 'fevereiro', 'março', 'abril', 'maio', 'junho',
+               'julho', 'agosto', 'setembro', 'outubro', 'novembro', 'dezembro')
+
+# página de consulta com a mesma estrutura que o Browser usa no site da FIPE:
+# selects com o campo de busca do chosen, botão de pesquisa e tabela de resultado.
+# O objeto jQuery expõe apenas o que o AdaptiveWait observa (active e ajaxComplete).
+SITE_PAGE = '''<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>Tabela FIPE</title></head>
+<body>
+<a href="#" id="tabCarro">Consulta de Carros e Utilitários Pequenos</a>
+<div id="formCarro" style="display: none">
+  <select id="selectTabelaReferenciacarro"></select>
+  <select id="selectMarcacarro"></select>
+  <select id="selectAnoModelocarro"></select>
+  <select id="selectAnocarro"></select>
+  <a href="#" id="buttonPesquisarcarro">Pesquisar</a>
+  <a href="#" id="buttonLimparPesquisarcarro">Limpar Pesquisa</a>
+  <div id="resultadoConsultacarroFiltros"></div>
+</div>
+<script>
+var API = 'api/veiculos/';
+var FIELDS = ['selectTabelaReferenciacarro', 'selectMarcacarro', 'selectAnoModelocarro', 'selectAnocarro'];
+var completed = [];
+
+window.jQuery = function () {
+    return {ajaxComplete: function (callback) { completed.push(callback); }};
+};
+jQuery.active = 0;
+
+function post(endpoint, params, done) {
+    var xhr = new XMLHttpRequest();
+    var body = Object.keys(params).map(function (key) {
+        return encodeURIComponent(key) + '=' + encodeURIComponent(params[key]);
+    }).join('&');
+    function finish() {
+        var data = null;
+        try { data = JSON.parse(xhr.responseText); } catch (err) {}
+        jQuery.active -= 1;
+        if (xhr.status === 200 && data !== null && !data.erro) done(data);
+        for (var i = 0; i < completed.length; i++) completed[i]();
+    }
+    jQuery.active += 1;
+    xhr.open('POST', API + endpoint, true);
+    xhr.setRequestHeader('Content-Type', 'application/x-www-form-urlencoded; charset=UTF-8');
+    xhr.onloadend = finish;
+    try { xhr.send(body); } catch (err) {}
+}
+
+function value(index) {
+    return document.getElementById(FIELDS[index]).value;
+}
+
+function fill(index, items) {
+    var select = document.getElementById(FIELDS[index]);
+    select.innerHTML = '<option value=""></option>';
+    items.forEach(function (item) {
+        var option = document.createElement('option');
+        option.value = item.Value;
+        option.textContent = item.Label;
+        select.appendChild(option);
+    });
+}
+
+function reset(index) {
+    for (var i = index; i < FIELDS.length; i++) fill(i, []);
+    document.getElementById('resultadoConsultacarroFiltros').innerHTML = '';
+}
+
+function params() {
+    return {
+        codigoTabelaReferencia: value(0),
+        codigoTipoVeiculo: 1,
+        codigoMarca: value(1),
+        codigoModelo: value(2)
+    };
+}
+
+function anoParams() {
+    var ano = value(3).split('-'), data = params();
+    data.anoModelo = ano[0];
+    data.codigoTipoCombustivel = ano[1];
+    return data;
+}
+
+var LOADERS = [
+    function () {
+        post('ConsultarMarcas', {codigoTabelaReferencia: value(0), codigoTipoVeiculo: 1}, function (data) { fill(1, data); });
+    },
+    function () {
+        var data = params();
+        delete data.codigoModelo;
+        post('ConsultarModelos', data, function (data) { fill(2, data.Modelos); });
+    },
+    function () {
+        post('ConsultarAnoModelo', params(), function (data) { fill(3, data); });
+    },
+    function () {
+        post('ConsultarModelosAtravesDoAno', anoParams(), function () {});
+    }
+];
+
+FIELDS.forEach(function (id, index) {
+    var container = document.createElement('div');
+    container.id = id + '_chosen';
+    container.className = 'chosen-container';
+    container.innerHTML = '<div class="chosen-drop"><div class="chosen-search"><input type="text" autocomplete="off"></div>' +
+        '<ul class="chosen-results"></ul></div>';
+    document.getElementById(id).insertAdjacentElement('afterend', container);
+
+    var input = container.querySelector('input');
+    var results = container.querySelector('ul');
+    var down = 0;
+    input.addEventListener('keydown', function (event) {
+        if (event.key === 'ArrowDown') {
+            event.preventDefault();
+            down += 1;
+        } else if (event.key === 'Enter') {
+            // como o chosen: escolhe a primeira opção que contém o texto digitado
+            event.preventDefault();
+            var text = input.value.trim().toLowerCase();
+            var options = document.getElementById(id).options;
+            var matches = [];
+            for (var i = 0; i < options.length; i++) {
+                if (options[i].value !== '' && options[i].textContent.toLowerCase().indexOf(text) !== -1) {
+                    matches.push(options[i]);
+                }
+            }
+            var item = document.createElement('li');
+            results.innerHTML = '';
+            results.appendChild(item);
+            if (matches.length === 0) {
+                item.textContent = 'Nada encontrado com "' + input.value + '"';
+            } else {
+                var option = matches[Math.min(down, matches.length - 1)];
+                item.textContent = option.textContent;
+                document.getElementById(id).value = option.value;
+                reset(index + 1);
+                LOADERS[index]();
+            }
+            input.value = '';
+            down = 0;
+        }
+    });
+});
+
+document.getElementById('tabCarro').addEventListener('click', function (event) {
+    event.preventDefault();
+    document.getElementById('formCarro').style.display = '';
+    post('ConsultarTabelaDeReferencia', {}, function (data) {
+        fill(0, data.map(function (item) { return {Label: item.Mes, Value: item.Codigo}; }));
+    });
+});
+
+document.getElementById('buttonLimparPesquisarcarro').addEventListener('click', function (event) {
+    event.preventDefault();
+    reset(1);
+});
+
+document.getElementById('buttonPesquisarcarro').addEventListener('click', function (event) {
+    event.preventDefault();
+    var data = anoParams();
+    data.tipoVeiculo = 'carro';
+    data.modeloCodigoExterno = '';
+    data.tipoConsulta = 'tradicional';
+    post('ConsultarValorComTodosParametros', data, function (data) {
+        var table = document.createElement('table');
+        [
+            ['Mês de referência:', data.MesReferencia],
+            ['Código Fipe:', data.CodigoFipe],
+            ['Marca:', data.Marca],
+            ['Modelo:', data.Modelo],
+            ['Ano Modelo:', data.AnoModelo],
+            ['Autenticação', data.Autenticacao],
+            ['Data da consulta', data.DataConsulta],
+            ['Preço Médio', data.Valor]
+        ].forEach(function (row) {
+            var line = table.insertRow();
+            line.insertCell().textContent = row[0];
+            line.insertCell().textContent = row[1];
+        });
+        var result = document.getElementById('resultadoConsultacarroFiltros');
+        result.innerHTML = '';
+        result.appendChild(table);
+    });
+});
+</script>
+</body>
+</html>
+'''
+
+
+def _key(endpoint: str, params: dict) -> str:
+    return json.dumps([endpoint, sorted((str(k), str(v)) for k, v in params.items())])
+
+
+class RecordedResponses:
+    """
+    Respostas gravadas da API da FIPE, indexadas por endpoint e parâmetros.
+    Pode ser usada como recorder do FipeApi para gravar uma sessão real.
+    """
+
+    def __init__(self, responses: dict = None):
+        self.responses = responses if responses is not None else {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint: str, params: dict, response):
+        with self.lock:
+            self.responses[_key(endpoint, params)] = response
+
+    def lookup(self, endpoint: str, params: dict):
+        return self.responses.get(_key(endpoint, params), NOT_FOUND)
+
+    def save(self, path: str):
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.responses, file, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, encoding='utf-8') as file:
+            return cls(json.load(file))
+
+
+# primeiro dígito do código fipe de carros, motos e caminhões, como no site
+FIPE_PREFIX = {1: 0, 2: 8, 3: 5}
+
+
+class SyntheticCatalog:
+    """
+    Catálogo gerado com `references` meses, `marcas` marcas, `modelos` modelos
+    por marca e `anos` anos por modelo, sem guardar as respostas em memória.
+    Cada tipo de veículo tem as mesmas marcas e modelos, com códigos fipe diferentes.
+    Responde como o RecordedResponses, então pode ser servido pelo MockFipeServer.
+    """
+
+    def __init__(self, references: int = 1, marcas: int = 5, modelos: int = 10, anos: int = 5,
+                 newest: tuple = (2018, 10), newest_code: int = 231):
+        self.references = references
+        self.marcas = marcas
+        self.modelos = modelos
+        self.anos = anos
+        self.newest = newest
+        self.newest_code = newest_code
+
+    @property
+    def size(self) -> int:
+        # quantidade de preços do catálogo
+        return self.references * self.marcas * self.modelos * self.anos
+
+    def reference(self, index: int) -> dict:
+        year, month = self.newest
+        month -= index
+        year += (month - 1) // 12
+        month = (month - 1) % 12 + 1
+        return {'Codigo': self.newest_code - index, 'Mes': '{}/{} '.format(MONTH_NAMES[month - 1], year)}
+
+    @staticmethod
+    def marca_label(marca: int) -> str:
+        return 'Marca {:03d}'.format(marca)
+
+    @staticmethod
+    def modelo_label(marca: int, modelo: int) -> str:
+        return 'Modelo {:03d}-{:03d} 1.0'.format(marca, modelo)
+
+    @staticmethod
+    def fipe_code(marca: int, modelo: int, vehicle_type: int = 1) -> str:
+        return '{}{:02d}{:03d}-{}'.format(FIPE_PREFIX[vehicle_type], marca, modelo, (marca + modelo) % 10)
+
+    @staticmethod
+    def _vehicle_type(params: dict) -> int:
+        vehicle_type = int(params.get('codigoTipoVeiculo') or 1)
+        if vehicle_type not in FIPE_PREFIX:
+            raise KeyError(vehicle_type)
+        return vehicle_type
+
+    def years(self) -> list:
+        return [self.newest[0] + 1 - k for k in range(self.anos)]
+
+    def _reference(self, params: dict):
+        index = self.newest_code - int(params.get('codigoTabelaReferencia') or 0)
+        if not 0 <= index < self.references:
+            raise KeyError(index)
+        return self.reference(index)
+
+    def _marca(self, params: dict) -> int:
+        marca = int(params.get('codigoMarca') or 0)
+        if not 1 <= marca <= self.marcas:
+            raise KeyError(marca)
+        return marca
+
+    def _modelo(self, params: dict, marca: int) -> int:
+        modelo = int(params.get('codigoModelo') or 0) - marca * 1000
+        if not 1 <= modelo <= self.modelos:
+            raise KeyError(modelo)
+        return modelo
+
+    def _year(self, params: dict) -> int:
+        year = int(params.get('anoModelo') or 0)
+        if year not in self.years() or str(params.get('codigoTipoCombustivel')) != '1':
+            raise KeyError(year)
+        return year
+
+    def price(self, reference: dict, marca: int, modelo: int, year: int, vehicle_type: int = 1) -> dict:
+        # preço determinístico, que cai com a idade e varia pouco entre os meses
+        base = 20000 + (marca * 7919 + modelo * 104729) % 180000
+        value = base * (0.9 ** (self.newest[0] + 1 - year)) * (1 + (reference['Codigo'] % 7) / 100.0)
+        text = '{:,.2f}'.format(value).replace(',', '_').replace('.', ',').replace('_', '.')
+        return {
+            'Valor': 'R$ {}'.format(text),
+            'Marca': self.marca_label(marca),
+            'Modelo': self.modelo_label(marca, modelo),
+            'AnoModelo': year,
+            'Combustivel': 'Gasolina',
+            'CodigoFipe': self.fipe_code(marca, modelo, vehicle_type),
+            'MesReferencia': reference['Mes'].strip().replace('/', ' de '),
+            'Autenticacao': '{:012x}'.format(hash((reference['Codigo'], marca, modelo, year)) & 0xffffffffffff),
+            'TipoVeiculo': vehicle_type,
+            'SiglaCombustivel': 'G',
+            'DataConsulta': time.strftime('%d/%m/%Y'),
+        }
+
+    def lookup(self, endpoint: str, params: dict):
+        try:
+            if endpoint == 'ConsultarTabelaDeReferencia':
+                return [self.reference(index) for index in range(self.references)]
+            reference = self._reference(params)
+            vehicle_type = self._vehicle_type(params)
+            if endpoint == 'ConsultarMarcas':
+                return [{'Label': self.marca_label(marca), 'Value': str(marca)} for marca in range(1, self.marcas + 1)]
+            if endpoint == 'ConsultarValorComTodosParametros' and params.get('tipoConsulta') == 'codigo':
+                code = str(params.get('modeloCodigoExterno', ''))
+                marca, modelo = int(code[1:3]), int(code[3:6])
+                if code != self.fipe_code(marca, modelo, vehicle_type):
+                    raise KeyError(code)
+                params = dict(params, codigoMarca=marca, codigoModelo=marca * 1000 + modelo)
+            marca = self._marca(params)
+            if endpoint == 'ConsultarModelos':
+                return {
+                    'Modelos': [
+                        {'Label': self.modelo_label(marca, modelo), 'Value': marca * 1000 + modelo}
+                        for modelo in range(1, self.modelos + 1)
+                    ],
+                    'Anos': [],
+                }
+            modelo = self._modelo(params, marca)
+            if endpoint == 'ConsultarAnoModelo':
+                return [{'Label': '{} Gasolina'.format(year), 'Value': '{}-1'.format(year)} for year in self.years()]
+            year = self._year(params)
+            if endpoint == 'ConsultarModelosAtravesDoAno':
+                return [{'Label': self.modelo_label(marca, modelo), 'Value': marca * 1000 + modelo}]
+            if endpoint == 'ConsultarValorComTodosParametros':
+                return self.price(reference, marca, modelo, year, vehicle_type)
+        except (KeyError, ValueError):
+            pass
+        return NOT_FOUND
+
+
+class MockFipeHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/':
+            self.send_error(404)
+            return
+        self.send_body(SITE_PAGE.encode('utf-8'), 'text/html; charset=utf-8')
+
+    def do_POST(self):
+        endpoint = self.path.rstrip('/').rsplit('/', 1)[-1]
+        length = int(self.headers.get('Content-Length') or 0)
+        params = dict(parse_qsl(self.rfile.read(length).decode('utf-8'), keep_blank_values=True))
+        if not self.server.delay():
+            self.send_error(500)
+            return
+        self.send_json(self.server.responses.lookup(endpoint, params))
+
+    def send_json(self, data, status: int = 200):
+        self.send_body(json.dumps(data, ensure_ascii=False).encode('utf-8'), 'application/json; charset=utf-8', status)
+
+    def send_body(self, body: bytes, content_type: str, status: int = 200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockFipeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, responses, host: str = '127.0.0.1', port: int = 0, handler=MockFipeHandler,
+                 latency: float = 0, jitter: float = 0, error_rate: float = 0, seed: int = None):
+        super().__init__((host, port), handler)
+        self.responses = responses
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.thread = None
+
+    @property
+    def site_url(self) -> str:
+        host, port = self.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    @property
+    def url(self) -> str:
+        return self.site_url + 'api/veiculos/'
+
+    def delay(self) -> bool:
+        # simula a latência da API; retorna False quando a requisição deve falhar
+        latency = self.latency + self.random.uniform(0, self.jitter)
+        if latency > 0:
+            time.sleep(latency)
+        return self.random.random() >= self.error_rate
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Site e API da FIPE simulados para testes e benchmarks')
+    parser.add_argument('responses', nargs='?', help='respostas gravadas; sem elas é usado um catálogo sintético')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--catalog', type=int, nargs=4, default=[1, 5, 10, 5],
+                        metavar=('REFERENCIAS', 'MARCAS', 'MODELOS', 'ANOS'))
+    parser.add_argument('--latency', type=float, default=0, help='segundos de espera em cada requisição da API')
+    parser.add_argument('--jitter', type=float, default=0, help='espera adicional aleatória, em segundos')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fração das requisições que falham com HTTP 500')
+    args = parser.parse_args()
+
+    responses = RecordedResponses.load(args.responses) if args.responses else SyntheticCatalog(*args.catalog)
+    server = MockFipeServer(responses, port=args.port, latency=args.latency, jitter=args.jitter,
+                            error_rate=args.error_rate)
+    print(server.site_url)
+    server.serve_forever()
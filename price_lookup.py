@@ -0,0 +1,92 @@
+"""
+Consulta de preços por código fipe, ano modelo e mês, respondida pela tabela
+price_index com um cache LRU na frente.
+
+uso:
+    python price_lookup.py rebuild                       preenche o índice com os preços já gravados
+    python price_lookup.py CÓDIGO 'ANO COMBUSTÍVEL' [AAAA-MM]
+"""
+import argparse
+import datetime
+import time
+
+from db_declarative import ENGINE, Database
+from fipe_api import parse_ano
+from lru import LruCache
+from metrics import REGISTRY
+
+_MISSING = object()
+
+
+class PriceLookup:
+    """
+    Preço de um código fipe e ano modelo em um mês, ou na referência mais
+    recente. As respostas ficam em um LruCache de `cache_size` itens publicado
+    nas métricas como cache="price_lookup". Os preços de um mês não mudam depois
+    de publicados, mas o mais recente é consultado de novo a cada `latest_ttl`
+    segundos para enxergar as referências novas.
+    """
+
+    def __init__(self, database: Database = None, cache_size: int = 100000, latest_ttl: float = 60):
+        self.database = database if database is not None else Database()
+        self.cache = LruCache(cache_size, 'price_lookup')
+        self.latest_ttl = latest_ttl
+        self.misses = REGISTRY.histogram('fipe_lookup_query_seconds', 'Duração das consultas fora do cache')
+
+    def price(self, fipe_code: str, year: int, fuel: int, period: datetime.date):
+        key = (fipe_code, year, fuel, period)
+        value = self.cache.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        with self.misses.time():
+            value = self.database.get_indexed_price(fipe_code, year, fuel, period)
+        # um preço que ainda não existe pode chegar com a próxima referência
+        if value is not None:
+            self.cache.put(key, value)
+        return value
+
+    def latest(self, fipe_code: str, year: int, fuel: int) -> tuple:
+        # (period, value) ou None
+        key = ('latest', fipe_code, year, fuel)
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        with self.misses.time():
+            latest = self.database.get_latest_indexed_price(fipe_code, year, fuel)
+        latest = tuple(latest) if latest is not None else None
+        self.cache.put(key, (time.monotonic() + self.latest_ttl, latest))
+        return latest
+
+    def clear(self):
+        self.cache.clear()
+
+    def rebuild(self):
+        self.database.index_prices()
+        self.database.session.commit()
+        self.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Consulta de preços da tabela FIPE por código fipe')
+    parser.add_argument('--url', default=ENGINE, help='banco do scraper')
+    parser.add_argument('fipe_code', help="código fipe, ou 'rebuild' para preencher o índice")
+    parser.add_argument('ano', nargs='?', help="ano modelo como no site, ex.: '2015 Gasolina'")
+    parser.add_argument('month', nargs='?', help='mês de referência AAAA-MM; sem ele, o mais recente')
+    args = parser.parse_args()
+
+    lookup = PriceLookup(Database(args.url))
+    if args.fipe_code == 'rebuild':
+        lookup.rebuild()
+        return
+    if args.ano is None:
+        parser.error('informe o ano modelo')
+    year, fuel = parse_ano(args.ano)
+    if args.month is None:
+        print(lookup.latest(args.fipe_code, year, fuel))
+    else:
+        period = datetime.datetime.strptime(args.month, '%Y-%m').date()
+        print(lookup.price(args.fipe_code, year, fuel, period))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from crawl_backend import parse_price
+from db_declarative import Database
+from fipe_api import CARRO, FipeApi, ano_code
+from metrics import price_saved
+
+
+class Repricer:
+    """
+    Consulta diretamente, pelo código fipe, o preço dos anos já conhecidos
+    em uma referência, sem navegar por marca, modelo e ano. As consultas rodam
+    em `workers` threads e os preços são gravados em lotes de `batch_size`.
+    """
+
+    def __init__(self, api: FipeApi = None, database: Database = None, workers: int = 8,
+                 batch_size: int = 500, vehicle_type: int = CARRO):
+        self.api = api if api is not None else FipeApi()
+        self.database = database if database is not None else Database(vehicle_type=vehicle_type)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.vehicle_type = vehicle_type
+
+    def reference(self, text: str = None):
+        # sem texto, usa a referência mais recente publicada pela FIPE
+        options = self.api.references()
+        codes = {option['Mes'].strip(): option['Codigo'] for option in options}
+        text = text or options[0]['Mes'].strip()
+        self.database.save_reference([text], force=True)
+        return self.database.get_reference_by_text(text), codes[text]
+
+    def fetch(self, ref_code: int, ano: tuple):
+        ano_id, label, fipe_code = ano
+        try:
+            result = self.api.price_by_code(ref_code, fipe_code, ano_code(label), self.vehicle_type)
+        except Exception as err:
+            sys.stderr.write('{} {}: {}\n'.format(fipe_code, label, err))
+            return None
+        return {'id_ano_modelo': ano_id, 'value': parse_price(result['Valor'])}
+
+    def run(self, text: str = None) -> int:
+        reference, ref_code = self.reference(text)
+        anos = self.database.get_coded_anos(reference.id)
+        print(datetime.now(), reference.text, len(anos), 'anos')
+
+        saved = 0
+        batch = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for price in executor.map(lambda ano: self.fetch(ref_code, ano), anos):
+                if price is None:
+                    continue
+                price['id_referencia'] = reference.id
+                batch.append(price)
+                if len(batch) >= self.batch_size:
+                    self.database.save_prices(batch)
+                    price_saved(len(batch))
+                    saved += len(batch)
+                    batch = []
+        self.database.save_prices(batch)
+        price_saved(len(batch))
+        saved += len(batch)
+        print(datetime.now(), reference.text, saved, 'preços')
+        return saved
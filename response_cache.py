@@ -0,0 +1,233 @@
+import json
+import sqlite3
+import threading
+import time
+
+from crawl_backend import CrawlBackend, VehicleNotFound
+from fipe_api import CARRO
+from metrics import REGISTRY
+
+HITS = REGISTRY.counter('fipe_cache_hits_total', 'Consultas respondidas pelo cache', cache='responses')
+MISSES = REGISTRY.counter('fipe_cache_misses_total', 'Consultas que não estavam no cache', cache='responses')
+EVICTIONS = REGISTRY.counter('fipe_cache_evictions_total', 'Itens descartados por falta de espaço', cache='responses')
+
+
+class CacheMiss(Exception):
+    # no modo replay, a consulta não foi gravada; não indica que o veículo não existe
+    pass
+
+
+class ResponseCache:
+    """
+    Respostas do site gravadas em disco, em um arquivo SQLite em `path`: as listas
+    de opções e os resultados das consultas, por tipo de veículo, referência,
+    marca, modelo e ano. Uma resposta vale por `ttl` segundos (None: para sempre)
+    e, quando o arquivo passa de `max_bytes`, as mais antigas são descartadas.
+    Pode ser compartilhado entre threads.
+    """
+
+    def __init__(self, path: str, ttl: float = 86400, max_bytes: int = 1 << 30):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS response '
+            '(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, stored_at REAL NOT NULL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS ix_response_stored_at ON response (stored_at)')
+        self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM response').fetchone()[0]
+
+    @staticmethod
+    def key(kind: str, vehicle_type: int, *path) -> str:
+        # ex.: ["anos", 1, "outubro/2018", "Fiat", "Uno 1.0"]
+        return json.dumps([kind, vehicle_type] + list(path), ensure_ascii=False)
+
+    def get(self, key: str, expired: bool = False):
+        # expired=True devolve a resposta mesmo depois do ttl
+        with self.lock:
+            row = self.connection.execute('SELECT value, stored_at FROM response WHERE key = ?', (key,)).fetchone()
+        if row is None or (not expired and self.ttl is not None and row[1] < time.time() - self.ttl):
+            MISSES.inc()
+            return None
+        HITS.inc()
+        return json.loads(row[0])
+
+    def put(self, key: str, value):
+        data = json.dumps(value, ensure_ascii=False)
+        size = len(key) + len(data)
+        with self.lock:
+            old = self.connection.execute('SELECT size FROM response WHERE key = ?', (key,)).fetchone()
+            self.connection.execute(
+                'INSERT OR REPLACE INTO response (key, value, size, stored_at) VALUES (?, ?, ?, ?)',
+                (key, data, size, time.time())
+            )
+            self.size += size - (old[0] if old is not None else 0)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # descarta as respostas vencidas e depois as mais antigas, até 90% de max_bytes
+        removed = 0
+        if self.ttl is not None:
+            removed += self.connection.execute(
+                'DELETE FROM response WHERE stored_at < ?', (time.time() - self.ttl,)
+            ).rowcount
+        self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM response').fetchone()[0]
+        target = self.max_bytes * 0.9
+        while self.size > target:
+            rows = self.connection.execute(
+                'SELECT key, size FROM response ORDER BY stored_at LIMIT 500'
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.size <= target:
+                    break
+                self.connection.execute('DELETE FROM response WHERE key = ?', (key,))
+                self.size -= size
+                removed += 1
+        EVICTIONS.inc(removed)
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM response').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+_caches = {}
+
+
+def open_cache(path: str, ttl: float = 86400, max_bytes: int = 1 << 30) -> ResponseCache:
+    # um cache por arquivo, compartilhado pelos backends do processo
+    if path not in _caches:
+        _caches[path] = ResponseCache(path, ttl, max_bytes)
+    return _caches[path]
+
+
+class CachingBackend(CrawlBackend):
+    """
+    Lê as listas de opções e os resultados pelo `cache` antes de consultar o
+    `backend`, gravando o que vier dele. As seleções só são repassadas ao backend
+    quando uma resposta não está no cache, então, depois de um reinício, o que
+    já foi consultado não navega pelo site de novo.
+
+    Com `replay`, não há backend: tudo vem do cache, sem considerar a validade,
+    e as consultas que não foram gravadas lançam CacheMiss.
+    """
+
+    FIELDS = ('reference', 'marca', 'modelo', 'ano')
+
+    def __init__(self, backend: CrawlBackend, cache: ResponseCache, vehicle_type: int = CARRO, replay: bool = False):
+        self.backend = backend
+        self.cache = cache
+        self.vehicle_type = vehicle_type
+        self.replay = replay
+        self.selected = dict.fromkeys(self.FIELDS)
+        self.applied = dict.fromkeys(self.FIELDS)
+        self.arrow_down = False
+        # sessão do backend em que `applied` foi aplicado (ex.: BrowserPool.generation)
+        self.generation = getattr(backend, 'generation', None)
+
+    def _select(self, field: str, value: str):
+        # os campos seguintes dependem deste, como no formulário do site
+        index = self.FIELDS.index(field)
+        for name in self.FIELDS[index:]:
+            self.selected[name] = None
+        self.selected[field] = value
+
+    def _path(self, depth: int) -> list:
+        return [self.selected[name] for name in self.FIELDS[:depth]]
+
+    def _sync(self, depth: int):
+        # repassa ao backend as seleções dos `depth` primeiros campos que ainda não foram aplicadas
+        generation = getattr(self.backend, 'generation', None)
+        if generation != self.generation:
+            # o backend trocou de sessão e o formulário da nova está vazio
+            self.applied = dict.fromkeys(self.FIELDS)
+            self.generation = generation
+        for name in self.FIELDS[:depth]:
+            value = self.selected[name]
+            if self.applied[name] == value:
+                continue
+            if name == 'reference':
+                self.backend.select_reference(value)
+            elif name == 'marca':
+                self.backend.select_marca(value, self.arrow_down)
+            elif name == 'modelo':
+                self.backend.select_modelo(value)
+            else:
+                self.backend.select_ano(value)
+            self.applied[name] = value
+            for following in self.FIELDS[self.FIELDS.index(name) + 1:]:
+                self.applied[following] = None
+
+    def _read(self, kind: str, depth: int, fetch):
+        key = self.cache.key(kind, self.vehicle_type, *self._path(depth))
+        value = self.cache.get(key, expired=self.replay)
+        if value is not None:
+            return value
+        if self.replay:
+            raise CacheMiss('{} não gravado: {}'.format(kind, key))
+        self._sync(depth)
+        value = fetch()
+        self.cache.put(key, value)
+        return value
+
+    def _options(self, kind: str, depth: int, fetch) -> list:
+        try:
+            return self._read(kind, depth, fetch)
+        except CacheMiss:
+            return []
+
+    def references(self) -> list:
+        return self._options('references', 0, lambda: self.backend.references())
+
+    def marcas(self) -> list:
+        return self._options('marcas', 1, lambda: self.backend.marcas())
+
+    def modelos(self) -> list:
+        return self._options('modelos', 2, lambda: self.backend.modelos())
+
+    def anos(self) -> list:
+        return self._options('anos', 3, lambda: self.backend.anos())
+
+    def select_reference(self, reference: str):
+        self._select('reference', reference)
+
+    def select_marca(self, marca: str, arrow_down: bool = False):
+        self._select('marca', marca)
+        self.arrow_down = arrow_down
+
+    def select_modelo(self, modelo: str):
+        self._select('modelo', modelo)
+
+    def select_ano(self, ano: str):
+        self._select('ano', ano)
+
+    def _search(self) -> dict:
+        # o veículo inexistente também é gravado, para ser reproduzido no replay
+        try:
+            return self.backend.search()
+        except VehicleNotFound as err:
+            return {'not_found': str(err)}
+
+    def search(self) -> dict:
+        result = self._read('result', 4, self._search)
+        if 'not_found' in result:
+            raise VehicleNotFound(result['not_found'])
+        return result
+
+    def restart(self):
+        self.applied = dict.fromkeys(self.FIELDS)
+        if self.backend is not None:
+            self.backend.restart()
+
+    def close(self):
+        if self.backend is not None:
+            self.backend.close()
@@ -0,0 +1,203 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+from db_declarative import VISITED, AnoModelo, Database, Modelo
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def price_record(reference, marca, modelo, ano, fipe_code: str, value: float) -> dict:
+    # registro plano de um preço, a partir dos objetos do banco usados pelo scraper
+    return {
+        'reference_id': reference.id,
+        'reference': reference.text,
+        'vehicle_type': reference.vehicle_type,
+        'marca': marca.marca_name if marca is not None else None,
+        'modelo_id': modelo.id,
+        'modelo': modelo.modelo_name,
+        'fipe_code': fipe_code,
+        'ano_id': ano.id,
+        'ano': ano.ano_modelo,
+        'value': value,
+        'crawled_at': datetime.now().isoformat(),
+    }
+
+
+class PriceSink:
+    """
+    Destino dos preços consultados. `write` recebe uma lista de registros
+    de price_record e só retorna depois de gravá-los.
+    """
+
+    def write(self, records: list):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class DatabaseSink(PriceSink):
+    """
+    Grava os preços no banco do scraper com comandos em lote: os preços, o
+    código fipe dos modelos, o índice de preços e o status dos anos vão na
+    mesma transação, assim um ano só fica visitado quando o seu preço está no banco.
+    """
+
+    def __init__(self, database: Database):
+        self.database = database
+
+    def insert_prices(self, records: list):
+        self.database.upsert_prices([
+            {'id_referencia': record['reference_id'], 'id_ano_modelo': record['ano_id'], 'value': record['value']}
+            for record in records
+        ])
+
+    def write(self, records: list):
+        if not records:
+            return
+        session = self.database.session
+        try:
+            self.insert_prices(records)
+            fipe_codes = {record['modelo_id']: record['fipe_code'] for record in records}
+            session.bulk_update_mappings(Modelo, [
+                {'id': modelo_id, 'fipe_code': fipe_code} for modelo_id, fipe_code in fipe_codes.items()
+            ])
+            self.database.index_prices((record['reference_id'], record['ano_id']) for record in records)
+            for chunk in self.database._chunks([record['ano_id'] for record in records]):
+                session.query(AnoModelo).filter(AnoModelo.id.in_(chunk)) \
+                    .update({AnoModelo.status: VISITED}, synchronize_session=False)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+
+class PostgresCopySink(DatabaseSink):
+    """
+    DatabaseSink que carrega os preços com COPY em uma tabela temporária e
+    os move para a tabela price com um único upsert.
+    """
+
+    def insert_prices(self, records: list):
+        data = io.StringIO()
+        writer = csv.writer(data)
+        for record in records:
+            writer.writerow((record['reference_id'], record['ano_id'], record['value']))
+        data.seek(0)
+        # o COPY usa a mesma conexão, e portanto a mesma transação, da sessão
+        cursor = self.database.session.connection().connection.cursor()
+        try:
+            cursor.execute(
+                'CREATE TEMPORARY TABLE IF NOT EXISTS price_load '
+                '(id_referencia integer, id_ano_modelo integer, value double precision) ON COMMIT DELETE ROWS'
+            )
+            cursor.copy_expert(
+                'COPY price_load (id_referencia, id_ano_modelo, value) FROM STDIN WITH (FORMAT csv)', data
+            )
+            cursor.execute(
+                'INSERT INTO price (id_referencia, id_ano_modelo, value) '
+                'SELECT DISTINCT ON (id_ano_modelo, id_referencia) id_referencia, id_ano_modelo, value FROM price_load '
+                'ON CONFLICT (id_ano_modelo, id_referencia) DO UPDATE SET value = EXCLUDED.value'
+            )
+        finally:
+            cursor.close()
+
+
+def database_sink(database: Database) -> DatabaseSink:
+    # COPY no Postgres; nos demais bancos, inserts em lote
+    if database.engine.dialect.name == 'postgresql':
+        return PostgresCopySink(database)
+    return DatabaseSink(database)
+
+
+class JsonlSink(PriceSink):
+    """
+    Acrescenta os preços, um JSON por linha, ao final de `path`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def write(self, records: list):
+        for record in records:
+            self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetSink(PriceSink):
+    """
+    Grava os preços em um arquivo Parquet, um row group a cada `row_group_size`
+    registros. O arquivo só fica legível depois do close. Requer o pyarrow.
+    """
+
+    def __init__(self, path: str, row_group_size: int = 10000):
+        if pyarrow is None:
+            raise RuntimeError('o sink parquet requer o pacote pyarrow')
+        self.path = path
+        self.row_group_size = row_group_size
+        self.schema = pyarrow.schema([
+            ('reference_id', pyarrow.int32()),
+            ('reference', pyarrow.string()),
+            ('vehicle_type', pyarrow.int8()),
+            ('marca', pyarrow.string()),
+            ('modelo_id', pyarrow.int32()),
+            ('modelo', pyarrow.string()),
+            ('fipe_code', pyarrow.string()),
+            ('ano_id', pyarrow.int32()),
+            ('ano', pyarrow.string()),
+            ('value', pyarrow.float64()),
+            ('crawled_at', pyarrow.string()),
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.buffer = []
+
+    def write(self, records: list):
+        self.buffer.extend(records)
+        if len(self.buffer) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        columns = [pyarrow.array([record[field.name] for record in self.buffer], field.type)
+                   for field in self.schema]
+        self.writer.write_table(pyarrow.Table.from_arrays(columns, schema=self.schema))
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class MultiSink(PriceSink):
+    """
+    Repassa os preços para vários sinks, na ordem dada. O sink do banco deve vir
+    primeiro: se ele falhar, os arquivos não recebem um preço que será consultado de novo.
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def write(self, records: list):
+        for sink in self.sinks:
+            sink.write(records)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def file_sink(path: str) -> PriceSink:
+    if path.endswith('.parquet'):
+        return ParquetSink(path)
+    return JsonlSink(path)
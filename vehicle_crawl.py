@@ -0,0 +1,51 @@
+import sys
+import threading
+
+from fipe_api import VEHICLE_NAMES
+from write_behind import WriteBehind
+
+
+class VehicleCrawl:
+    """
+    Percorre as tabelas de vários tipos de veículo (carros, motos e caminhões)
+    ao mesmo tempo, uma Application por tipo, cada uma em sua thread, com
+    backend e sessão próprios. A lista de referências é lida e salva uma única
+    vez para todos os tipos e os preços de todos são gravados pelo mesmo `writer`.
+
+    `make_app(vehicle_type, writer)` deve retornar uma nova Application.
+    """
+
+    def __init__(self, make_app, vehicle_types: list, writer: WriteBehind):
+        self.make_app = make_app
+        self.vehicle_types = vehicle_types
+        self.writer = writer
+
+    def crawl(self, app):
+        try:
+            app.crawl_references()
+        except Exception as err:
+            sys.stderr.write('{}: {}\n'.format(VEHICLE_NAMES[app.vehicle_type], err))
+        finally:
+            app.close(writer=False)
+
+    def run(self):
+        apps = []
+        try:
+            try:
+                for vehicle_type in self.vehicle_types:
+                    apps.append(self.make_app(vehicle_type, self.writer))
+                apps[0].save_references(self.vehicle_types)
+            except Exception:
+                for app in apps:
+                    app.close(writer=False)
+                raise
+            threads = [
+                threading.Thread(target=self.crawl, args=(app,), name=VEHICLE_NAMES[app.vehicle_type])
+                for app in apps
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.writer.close()
@@ -0,0 +1,123 @@
+from collections import deque
+from time import monotonic
+
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.support.ui import WebDriverWait
+
+from metrics import REGISTRY
+
+# conta as requisições ajax concluídas pelo jQuery da página
+INSTALL_XHR_HOOK_SCRIPT = '''
+if (window.jQuery && !window.__xhrHook) {
+    window.__xhrHook = true;
+    window.__xhrDone = 0;
+    jQuery(document).ajaxComplete(function () { window.__xhrDone += 1; });
+}
+'''
+
+XHR_DONE_SCRIPT = 'return window.__xhrDone || 0;'
+
+XHR_IDLE_SCRIPT = '''
+var active = window.jQuery ? jQuery.active : 0;
+return active === 0 && (window.__xhrDone || 0) > arguments[0];
+'''
+
+RESULT_READY_SCRIPT = '''
+var table = document.querySelector('#' + arguments[0] + ' table');
+return table !== null && table.rows.length > 0;
+'''
+
+OPTIONS_READY_SCRIPT = '''
+var select = document.getElementById(arguments[0]);
+if (select === null) return false;
+for (var i = 0; i < select.options.length; i++) {
+    if (select.options[i].textContent.trim() !== '') return true;
+}
+return false;
+'''
+
+
+class LatencyTracker:
+    """
+    Guarda as últimas `window` latências de cada etapa (em segundos) e as
+    publica nas métricas como fipe_wait_seconds{step=...}, com os timeouts
+    em fipe_wait_timeouts_total{step=...}.
+    """
+
+    def __init__(self, window: int = 500):
+        self.window = window
+        self.samples = {}
+        self.timeouts = {}
+
+    def record(self, step: str, seconds: float):
+        self.samples.setdefault(step, deque(maxlen=self.window)).append(seconds)
+        REGISTRY.histogram('fipe_wait_seconds', 'Duração das esperas por etapa', step=step).observe(seconds)
+
+    def record_timeout(self, step: str):
+        self.timeouts[step] = self.timeouts.get(step, 0) + 1
+        REGISTRY.counter('fipe_wait_timeouts_total', 'Esperas que excederam o timeout', step=step).inc()
+
+    def percentile(self, step: str, q: float):
+        samples = sorted(self.samples.get(step, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class AdaptiveWait:
+    """
+    Espera por sinais reais de conclusão na página em vez de pausas fixas.
+    O timeout de cada etapa é `factor` vezes o p99 observado, limitado entre
+    `min_timeout` e `max_timeout`; até juntar `warmup` amostras usa `default_timeout`.
+    """
+
+    def __init__(self, driver, tracker: LatencyTracker = None, default_timeout: float = 10,
+                 min_timeout: float = 1, max_timeout: float = 30, factor: float = 3,
+                 warmup: int = 20, poll: float = 0.05):
+        self.driver = driver
+        self.tracker = tracker if tracker is not None else LatencyTracker()
+        self.default_timeout = default_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.factor = factor
+        self.warmup = warmup
+        self.poll = poll
+
+    def timeout(self, step: str) -> float:
+        if len(self.tracker.samples.get(step, ())) < self.warmup:
+            return self.default_timeout
+        p99 = self.tracker.percentile(step, 0.99)
+        return min(self.max_timeout, max(self.min_timeout, p99 * self.factor))
+
+    def until(self, step: str, condition):
+        begin = monotonic()
+        try:
+            result = WebDriverWait(self.driver, self.timeout(step), poll_frequency=self.poll).until(condition)
+        except TimeoutException:
+            self.tracker.record_timeout(step)
+            raise
+        self.tracker.record(step, monotonic() - begin)
+        return result
+
+    def install(self):
+        self.driver.execute_script(INSTALL_XHR_HOOK_SCRIPT)
+
+    def xhr_mark(self) -> int:
+        return self.driver.execute_script(XHR_DONE_SCRIPT)
+
+    def xhr(self, step: str, mark: int):
+        # aguarda uma nova requisição ajax terminar depois de `mark`
+        try:
+            return self.until(step, lambda driver: driver.execute_script(XHR_IDLE_SCRIPT, mark))
+        except TimeoutException:
+            # a ação pode não ter disparado ajax; segue se não há nada pendente
+            if self.driver.execute_script(XHR_IDLE_SCRIPT, -1):
+                return True
+            raise
+
+    def result(self, step: str, container_id: str):
+        return self.until(step, lambda driver: driver.execute_script(RESULT_READY_SCRIPT, container_id))
+
+    def options(self, step: str, select_id: str):
+        # aguarda o select ter ao menos uma opção preenchida
+        return self.until(step, lambda driver: driver.execute_script(OPTIONS_READY_SCRIPT, select_id))
@@ -0,0 +1,101 @@
+import sys
+import threading
+
+
+class WorkerPool:
+    """
+    Executa o scraper com vários backends em paralelo sobre o mesmo banco.
+    O coordenador lista as marcas e os modelos da referência e cada worker,
+    com seu próprio backend e sua própria sessão, reserva um modelo não visitado
+    (status VISITING) e consulta todos os seus anos.
+
+    Um modelo com anos pendentes fica reservado até a próxima execução, que
+    libera as reservas, e a sua referência não é marcada como visitada.
+
+    `make_app` deve retornar uma nova Application a cada chamada.
+    """
+
+    def __init__(self, make_app, workers: int = 4):
+        self.make_app = make_app
+        self.workers = workers
+        self.incomplete = False
+
+    def list_modelos(self, app):
+        database = app.database
+        for app.marca in database.get_unvisited_marcas(app.reference.id):
+            try:
+                app.backend.select_reference(app.reference.text)
+                app.select_marca_input()
+                database.save_modelos(app.backend.modelos(), app.marca.id)
+            except Exception as err:
+                sys.stderr.write('{}\n'.format(err))
+                app.restart_browser()
+            else:
+                database.set_marca_visited(app.marca.id)
+
+    def work(self, reference_id: int):
+        try:
+            app = self.make_app()
+        except Exception as err:
+            sys.stderr.write('{}\n'.format(err))
+            return
+        database = app.database
+        app.reference = database.get_reference(reference_id)
+        try:
+            while True:
+                app.modelo = database.claim_modelo()
+                if app.modelo is None:
+                    break
+                app.marca = database.get_marca(app.modelo.marca_id)
+                try:
+                    app.backend.select_reference(app.reference.text)
+                    app.select_marca_input()
+                    app.backend.select_modelo(app.modelo.modelo_name)
+                    complete = app.select_ano()
+                except Exception as err:
+                    sys.stderr.write('{}\n'.format(err))
+                    database.release_modelo(app.modelo.id)
+                    app.restart_browser()
+                else:
+                    if not (complete and app.set_modelo_visited()):
+                        self.incomplete = True
+        finally:
+            app.close()
+            database.close()
+
+    def run(self):
+        coordinator = self.make_app()
+        database = coordinator.database
+        # reservas deixadas por uma execução interrompida
+        database.release_visiting()
+        database.save_reference(coordinator.backend.references())
+
+        try:
+            # uma referência incompleta encerra o percurso e fica para a próxima execução
+            for coordinator.reference in database.get_unvisited_references():
+                self.incomplete = False
+                coordinator.backend.select_reference(coordinator.reference.text)
+                # a lista de marcas só é salva quando não há
+                # nenhuma marca ou modelo pendente dessa referência
+                if not database.get_unvisited_marcas(coordinator.reference.id) \
+                        and not database.has_unvisited_modelo(reference_id=coordinator.reference.id):
+                    database.save_marcas(coordinator.backend.marcas(), coordinator.reference.id)
+                # enquanto houver marcas com modelos a listar, repete a listagem
+                while database.get_unvisited_marcas(coordinator.reference.id):
+                    self.list_modelos(coordinator)
+
+                threads = [
+                    threading.Thread(target=self.work, args=(coordinator.reference.id,), name='worker-{}'.format(i))
+                    for i in range(self.workers)
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+                if self.incomplete or database.has_unvisited_modelo(reference_id=coordinator.reference.id):
+                    sys.stderr.write('referência {} incompleta\n'.format(coordinator.reference.text))
+                    break
+                database.set_reference_visited(coordinator.reference.id)
+        finally:
+            coordinator.close()
@@ -0,0 +1,146 @@
+import queue
+import sys
+import threading
+import time
+
+from db_declarative import ENGINE, Database
+from metrics import REGISTRY, RETRIES
+from sinks import PriceSink, database_sink
+
+FLUSH = REGISTRY.histogram('fipe_write_flush_seconds', 'Duração da gravação de um lote de preços')
+DROPPED = REGISTRY.counter('fipe_write_dropped_total', 'Preços descartados depois de esgotar as tentativas')
+
+_STOP = object()
+_FLUSH = object()
+
+
+class WriteBehind:
+    """
+    Grava os resultados do scraper em segundo plano. Os preços vão para uma
+    fila limitada e uma thread dedicada, com sessão própria, grava lotes de até
+    `batch_size` itens ou a cada `flush_interval` segundos. Quando a fila enche,
+    `save_price` bloqueia o scraper até o banco acompanhar.
+
+    Cada lote é gravado pelo sink do banco (ver sinks.database_sink) e depois
+    em `files`, um sink de arquivo opcional usado apenas pela thread do writer.
+    Um lote que falha `max_attempts` vezes em um sink é descartado nele e
+    contado em `dropped`; `drain` informa os descartes a quem o chama, para
+    que o modelo desses preços não seja marcado como visitado.
+    """
+
+    def __init__(self, url: str = ENGINE, max_queue: int = 1000, batch_size: int = 200,
+                 flush_interval: float = 1.0, max_backoff: float = 60, files: PriceSink = None,
+                 max_attempts: int = 8):
+        self.url = url
+        self.files = files
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.dropped = 0
+        # valor de `dropped` no último drain de cada thread
+        self.drained = {}
+        self.thread = threading.Thread(target=self.run, name='write-behind', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def save_price(self, record: dict):
+        # record no formato de sinks.price_record
+        self.queue.put(record)
+
+    def drain(self) -> int:
+        # aguarda até que tudo o que foi enfileirado esteja gravado, sem esperar o
+        # flush_interval do lote atual, e retorna quantos preços foram descartados
+        # desde o último drain desta thread, incluindo os de outras threads no mesmo período
+        self.queue.put(_FLUSH)
+        self.queue.join()
+        thread = threading.get_ident()
+        with self.lock:
+            dropped = self.dropped - self.drained.get(thread, 0)
+            self.drained[thread] = self.dropped
+        return dropped
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join()
+
+    def _next_batch(self) -> list:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while batch[-1] is not _STOP and batch[-1] is not _FLUSH and len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self, sinks: list, items: list):
+        # cada sink é repetido separadamente, para que uma falha no
+        # arquivo não grave o lote novamente no banco
+        for sink in sinks:
+            for attempt in range(self.max_attempts):
+                try:
+                    with FLUSH.time():
+                        sink.write(items)
+                    break
+                except Exception as err:
+                    sys.stderr.write('{}\n'.format(err))
+                    if attempt == self.max_attempts - 1:
+                        self.drop(items)
+                        break
+                    RETRIES.inc()
+                    time.sleep(min(self.max_backoff, 2 ** attempt))
+
+    def drop(self, items: list):
+        sys.stderr.write('{} preços descartados pelo write-behind\n'.format(len(items)))
+        DROPPED.inc(len(items))
+        with self.lock:
+            self.dropped += len(items)
+
+    def open(self) -> Database:
+        for attempt in range(self.max_attempts):
+            try:
+                return Database(self.url)
+            except Exception as err:
+                sys.stderr.write('{}\n'.format(err))
+                if attempt == self.max_attempts - 1:
+                    raise
+                RETRIES.inc()
+                time.sleep(min(self.max_backoff, 2 ** attempt))
+
+    def run(self):
+        # sem banco, a fila continua sendo consumida e descartada,
+        # para que save_price, drain e close não fiquem bloqueados
+        database, sinks = None, None
+        try:
+            database = self.open()
+            sinks = [database_sink(database)]
+            if self.files is not None:
+                sinks.append(self.files)
+        except Exception as err:
+            sys.stderr.write('write-behind sem banco: {}\n'.format(err))
+        try:
+            while True:
+                batch = self._next_batch()
+                items = [item for item in batch if item is not _STOP and item is not _FLUSH]
+                if items and sinks is None:
+                    self.drop(items)
+                elif items:
+                    self.flush(sinks, items)
+                for _ in batch:
+                    self.queue.task_done()
+                if batch[-1] is _STOP:
+                    return
+        finally:
+            if database is not None:
+                database.close()
+            if self.files is not None:
+                self.files.close()